@@ -2,30 +2,58 @@
 Bitcoin
 
 Usage:
-  bitcoin.py serve
+  bitcoin.py serve [--assume-valid=<block_id>] [--handshake-names] [--datadir=<dir>]
+                   [--prune=<n>]
   bitcoin.py ping [--node <node>]
   bitcoin.py tx <from> <to> <amount> [--node <node>]
-  bitcoin.py balance <name> [--node <node>]
+  bitcoin.py balance <name>... [--node <node>]
 
 Options:
-  -h --help      Show this screen.
-  --node=<node>  Hostname of node [default: node0]
+  -h --help                  Show this screen.
+  --node=<node>              Hostname of node [default: node0]
+  --assume-valid=<block_id>  Skip signature checks on ancestors of this
+                             block, 0 verifies everything [default: 0]
+  --handshake-names          Identify peers by the name they send in the
+                             handshake instead of reverse DNS
+  --datadir=<dir>            Where blocks are stored [default: data]
+  --prune=<n>                Delete blocks more than this deep, keeping
+                             their headers and the UTXO set. 0 keeps
+                             everything [default: 0]
 """
 
-import uuid, socketserver, socket, sys, argparse, time, os, logging, threading, hashlib, random, re, pickle
+import asyncio, socket, sys, argparse, time, os, logging, threading, hashlib, random, re, io, struct, zlib, itertools, mmap, multiprocessing
 
 from docopt import docopt
 from copy import deepcopy
-from ecdsa import SigningKey, SECP256k1
+from functools import lru_cache, partial
+from collections import OrderedDict, Counter, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
+from ecdsa.ellipticcurve import Point
+import signatures
+from signatures import sign, verify, private_key_from_exponent
 
 PORT = 10000
 node = None
+runtime = None
 lock = threading.Lock()
 mining_interrupt = threading.Event()
 
 SATOSHIS_PER_COIN = 100_000_000
 GET_BLOCKS_CHUNK = 10
 HALVENING_INTERVAL = 60 * 24            # daily (assuming 1 minute blocks)
+SIGNATURE_SIZE = 64                     # raw r||s
+SIG_CACHE_SIZE = 100_000                # verified (sighash, sig, pubkey) triples
+VERIFY_WORKERS = os.cpu_count()
+PARALLEL_VERIFY_THRESHOLD = 16          # fewer signatures are checked inline
+PUBLIC_KEY_CACHE_SIZE = 10_000          # distinct interned VerifyingKeys
+REJECT_CACHE_SIZE = 10_000              # known-invalid block / tx ids
+PARTIAL_BLOCKS_SIZE = 16                # compact blocks awaiting missing txns
+SHORT_ID_SIZE = 6                       # bytes per tx in compact blocks
+BLOCK_CACHE_SIZE = 64                   # stored block bodies kept decoded
+
+# Rejections which could succeed later, so are never cached
+TRANSIENT_REJECTIONS = {"time-too-new"}
 
 INITIAL_DIFFICULTY_BITS = 17
 BLOCK_TIME_IN_SECS = 1
@@ -36,9 +64,147 @@ logging.basicConfig(level="INFO", format='%(threadName)-6s | %(message)s')
 logger = logging.getLogger(__name__)
 
 
+class Rejected(Exception):
+    """Invalid block or tx, with a short machine-readable reason code"""
+
+    def __init__(self, reason, message=""):
+        super().__init__(f"{reason} ({message})" if message else reason)
+        self.reason = reason
+
+def check(condition, reason, message=""):
+    if not condition:
+        raise Rejected(reason, message)
+
+def rejection_reason(exception):
+    if isinstance(exception, Rejected):
+        return exception.reason
+    if isinstance(exception, BadSignatureError):
+        return "bad-sig"
+
+class RejectCache:
+    """Bounded LRU map of known-invalid ids to their rejection reason"""
+
+    def __init__(self, max_size=REJECT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, id):
+        return self.entries.get(id)
+
+    def add(self, id, reason):
+        self.entries[id] = reason
+        self.entries.move_to_end(id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def forget(self, reason):
+        for id in [id for id, r in self.entries.items() if r == reason]:
+            del self.entries[id]
+
+class SignatureCache:
+    """Bounded LRU set of signatures which already passed ECDSA verification"""
+
+    def __init__(self, max_size=SIG_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, message, signature, public_key):
+        preimage = message + signature + public_key.to_string()
+        return hashlib.sha256(preimage).digest()
+
+    def contains(self, message, signature, public_key):
+        key = self.key(message, signature, public_key)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+        return False
+
+    def add(self, message, signature, public_key):
+        key = self.key(message, signature, public_key)
+        with self.lock:
+            self.entries[key] = None
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+sig_cache = SignatureCache()
+verify_pool = None
+
+def get_verify_pool():
+    # Started lazily, when the loop, miner and reply threads may be holding
+    # locks, so spawn workers fresh rather than forking them mid-lock
+    global verify_pool
+    if verify_pool is None:
+        verify_pool = ProcessPoolExecutor(max_workers=VERIFY_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"))
+    return verify_pool
+
+def shutdown_verify_pool():
+    global verify_pool
+    if verify_pool is not None:
+        verify_pool.shutdown(wait=False)
+        verify_pool = None
+
+def verify_signature(job):
+    # Runs in a worker process. Keys arrive encoded, 33 bytes rather than a
+    # pickled VerifyingKey, and decode to the worker's interned copy
+    message, signature, raw_public_key = job
+    try:
+        return verify(decode_public_key(raw_public_key), signature, message)
+    except BadSignatureError:
+        return False
+
+def verify_block_signatures(block, utxo_set):
+    # Collect every input signature we haven't already verified
+    jobs = []
+    for tx in block.txns[1:]:
+        sighash = SighashContext(tx)
+        for index, tx_in in enumerate(tx.tx_ins):
+            # Missing outputs are rejected later by validate_tx
+            if tx_in.outpoint not in utxo_set:
+                continue
+            # ... as are missing or malformed signatures, by verify_input
+            if not tx_in.signature or len(tx_in.signature) != SIGNATURE_SIZE:
+                continue
+            public_key = utxo_set[tx_in.outpoint].public_key
+            message = sighash.message(index)
+            if not sig_cache.contains(message, tx_in.signature, public_key):
+                jobs.append((message, tx_in.signature, public_key))
+
+    # Not worth the inter-process overhead, let validate_tx check them
+    if len(jobs) < PARALLEL_VERIFY_THRESHOLD:
+        return
+
+    # Fan out to worker processes, then cache results so validate_tx skips them
+    chunksize = max(len(jobs) // (VERIFY_WORKERS * 4), 1)
+    encoded = [(message, signature, encode_public_key(public_key))
+               for message, signature, public_key in jobs]
+    results = get_verify_pool().map(verify_signature, encoded,
+                                    chunksize=chunksize)
+    for job, valid in zip(jobs, results):
+        if not valid:
+            raise BadSignatureError("Invalid signature in block")
+        sig_cache.add(*job)
+
+class SighashContext:
+    """Serializes a transaction's outputs once for signing / verifying all inputs"""
+
+    def __init__(self, tx):
+        self.tx = tx
+        self.outputs = encode_tx_outs(tx.tx_outs)
+        self.outputs_digest = hashlib.sha256(self.outputs).digest()
+
+    def message(self, index):
+        outpoint = self.tx.tx_ins[index].outpoint
+        return encode_outpoint(*outpoint) + self.outputs_digest
+
 def spend_message(tx, index):
-    outpoint = tx.tx_ins[index].outpoint
-    return serialize(outpoint) + serialize(tx.tx_outs)
+    return SighashContext(tx).message(index)
 
 def total_work(blocks):
     return sum([2**block.bits for block in blocks])
@@ -56,15 +222,40 @@ class Tx:
         self.tx_ins = tx_ins
         self.tx_outs = tx_outs
 
-    def sign_input(self, index, private_key):
-        message = spend_message(self, index)
-        signature = private_key.sign(message)
+    def sign_input(self, index, private_key, sighash=None):
+        if sighash is None:
+            sighash = SighashContext(self)
+        message = sighash.message(index)
+        signature = sign(private_key, message)
         self.tx_ins[index].signature = signature
 
-    def verify_input(self, index, public_key):
+    def verify_input(self, index, public_key, sighash=None):
+        if sighash is None:
+            sighash = SighashContext(self)
         tx_in = self.tx_ins[index]
-        message = spend_message(self, index)
-        return public_key.verify(tx_in.signature, message)
+        message = sighash.message(index)
+
+        # Raw r||s, anything else can't verify (and can't be cached)
+        check(isinstance(tx_in.signature, bytes)
+              and len(tx_in.signature) == SIGNATURE_SIZE,
+              "bad-sig", "Missing or malformed signature")
+
+        # Skip ECDSA if we've already verified this exact signature
+        if sig_cache.contains(message, tx_in.signature, public_key):
+            return True
+
+        # Raises BadSignatureError, so only valid signatures get cached
+        verify(public_key, tx_in.signature, message)
+        sig_cache.add(message, tx_in.signature, public_key)
+        return True
+
+    def finalize(self):
+        # Id commits to the signed contents, so call this after signing
+        self.id = compute_tx_id(self)
+        for index, tx_out in enumerate(self.tx_outs):
+            tx_out.tx_id = self.id
+            tx_out.index = index
+        return self
 
     @property
     def is_coinbase(self):
@@ -73,6 +264,12 @@ class Tx:
     def __eq__(self, other):
         return self.id == other.id
 
+    def __hash__(self):
+        return hash(self.id)
+
+    def __reduce__(self):
+        return (decode_tx, (encode_tx(self),))
+
 class TxIn:
 
     def __init__(self, tx_id, index, signature=None):
@@ -96,6 +293,9 @@ class TxOut:
     def outpoint(self):
         return (self.tx_id, self.index)
 
+    def __reduce__(self):
+        return (decode_utxo, (encode_utxo(self),))
+
 class Block:
 
     def __init__(self, txns, prev_id, nonce, bits, timestamp):
@@ -107,7 +307,7 @@ class Block:
 
     @property
     def header(self):
-        return serialize(self)
+        return encode_block_header(self)
 
     @property
     def id(self):
@@ -128,6 +328,82 @@ class Block:
         prev_id = self.prev_id[:10] if self.prev_id else None
         return f"Block(prev_id={prev_id}... id={self.id[:10]}...)"
 
+    def __reduce__(self):
+        return (decode_block, (encode_block(self),))
+
+class StoredBlock(Block):
+    """
+    A connected block as just its header. The body is read back from the
+    block store when something asks for txns, so resident memory tracks
+    chain height rather than tx volume.
+    """
+
+    def __init__(self, store, header):
+        self.store = store
+        self.prev_id, self.bits, self.timestamp, self.nonce = \
+            read_block_header(io.BytesIO(header))
+        self._header = header
+        self._id = hashlib.sha256(header).hexdigest()
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def txns(self):
+        return self.store.body(self._id).txns
+
+class CompactBlock:
+    """
+    A block as its header plus salted short ids of its txns, for peers who
+    already have most of them in their mempool. Some txns (always the
+    coinbase) are sent in full.
+    """
+
+    def __init__(self, header, salt, short_ids, prefilled):
+        self.header = header
+        self.salt = salt
+        self.short_ids = short_ids
+        self.prefilled = prefilled      # [(index, tx)]
+
+    @classmethod
+    def from_block(cls, block, salt=None):
+        if salt is None:
+            salt = random.getrandbits(64)
+        header = block.header
+        key = short_id_key(header, salt)
+        return cls(header, salt,
+                   [short_tx_id(key, tx.id) for tx in block.txns[1:]],
+                   [(0, block.txns[0])])
+
+    @property
+    def id(self):
+        return hashlib.sha256(self.header).hexdigest()
+
+    def reconstruct(self, mempool):
+        # Txns in block order, None for any we couldn't find
+        txns = [None] * (len(self.short_ids) + len(self.prefilled))
+        for index, tx in self.prefilled:
+            check(index < len(txns) and txns[index] is None, "bad-cmpctblock",
+                  "Bad prefilled index")
+            txns[index] = tx
+        key = short_id_key(self.header, self.salt)
+        known = {short_tx_id(key, tx.id): tx for tx in mempool}
+        slots = [index for index, tx in enumerate(txns) if tx is None]
+        for index, short_id in zip(slots, self.short_ids):
+            txns[index] = known.get(short_id)
+        return txns
+
+    def to_block(self, txns):
+        # The txns digest is left for the caller to compare
+        prev_id, bits, timestamp, nonce = read_block_header(io.BytesIO(self.header))
+        return Block(txns=txns, prev_id=prev_id, nonce=nonce, bits=bits,
+                     timestamp=timestamp)
+
 class Node:
 
     def __init__(self, address):
@@ -138,12 +414,25 @@ class Node:
         self.peers = []
         self.pending_peers = []
         self.address = address
+        self.assume_valid = None
+        self.assumed_valid_ids = set()
+        self.peer_features = {}
+        self.rejected_blocks = RejectCache()
+        self.rejected_txs = RejectCache()
+        self.peer_rejections = defaultdict(Counter)
+        self.partial_blocks = OrderedDict()
+        self.store = None
+        self.prune_depth = None
+
+    @property
+    def features(self):
+        return FEATURES | (FEATURE_PRUNED if self.prune_depth else 0)
 
     def connect(self, peer):
         if peer not in self.peers and peer != self.address:
             logger.info(f'(handshake) Sent "connect" to {peer[0]}')
             try:
-                send_message(peer, "connect", None)
+                send_message(peer, "connect", (self.features, self.address[0]))
                 self.pending_peers.append(peer)
             except:
                 logger.info(f'(handshake) Node {peer[0]} offline')
@@ -151,12 +440,46 @@ class Node:
     def sync(self):
         blocks = self.blocks[-GET_BLOCKS_CHUNK:]
         block_ids = [block.id for block in blocks]
-        for peer in self.peers:
+        # Pruned peers only have recent blocks, so ask them as a last resort
+        peers = [peer for peer in self.peers
+                 if not self.peer_features.get(peer, 0) & FEATURE_PRUNED]
+        for peer in peers or self.peers:
             send_message(peer, "sync", block_ids)
 
     def fetch_utxos(self, public_key):
+        # Interned keys usually match by identity, skipping point comparison
+        public_key = intern_public_key(public_key)
         return [tx_out for tx_out in self.utxo_set.values() 
-                if tx_out.public_key == public_key]
+                if tx_out.public_key is public_key
+                or tx_out.public_key == public_key]
+
+    def resume(self, store):
+        """Loads the chain stored on disk, then stores new blocks there too"""
+        self.store = store
+        blocks = store.chain()
+        block_ids = {block.id: height for (height, block) in enumerate(blocks)}
+
+        # Pruned blocks are only there as headers, so start from the UTXO
+        # set snapshotted when they were pruned. A reorg may have left the
+        # snapshot's tip off our chain since, so back it up to where it forks
+        block_id, utxos = store.load_utxos()
+        for tx_out in utxos or ():
+            self.utxo_set[tx_out.outpoint] = tx_out
+        while block_id is not None and block_id not in block_ids:
+            block = store.body(block_id)
+            self.disconnect_block(block)
+            block_id = block.prev_id
+        start = block_ids[block_id] + 1 if block_id is not None else 0
+
+        for block in blocks[start:]:
+            for tx in block.txns:
+                self.connect_tx(tx)
+        # Backing up put txs in the mempool the chain may since have spent
+        self.mempool.clear()
+        self.blocks = blocks
+        if self.prune_depth:
+            self.prune()
+        return len(self.blocks)
 
     def connect_tx(self, tx):
         # Remove utxos that were just spent
@@ -172,11 +495,14 @@ class Node:
         if tx in self.mempool:
             self.mempool.remove(tx)
 
-    def disconnect_tx(self, tx):
+    def disconnect_tx(self, tx, spent=None):
         # Add back UTXOs spent by this transaction
         if not tx.is_coinbase:
             for tx_in in tx.tx_ins:
-                tx_out = tx_in_to_tx_out(tx_in, self.blocks)
+                if spent:
+                    tx_out = next(spent)
+                else:
+                    tx_out = tx_in_to_tx_out(tx_in, self.blocks)
                 self.utxo_set[tx_out.outpoint] = tx_out
 
         # Remove UTXOs created by this transaction
@@ -194,19 +520,21 @@ class Node:
         # Sum the amounts
         return sum([tx_out.amount for tx_out in utxos])
 
-    def validate_tx(self, tx):
+    def validate_tx(self, tx, verify_signatures=True):
         in_sum = 0
         out_sum = 0
+        sighash = SighashContext(tx)
         for index, tx_in in enumerate(tx.tx_ins):
             # TxIn spending an unspent output
-            assert tx_in.outpoint in self.utxo_set
+            check(tx_in.outpoint in self.utxo_set, "missing-input")
 
             # Grab the tx_out
             tx_out = self.utxo_set[tx_in.outpoint]
 
             # Verify signature using public key of TxOut we're spending
             public_key = tx_out.public_key
-            tx.verify_input(index, public_key)
+            if verify_signatures:
+                tx.verify_input(index, public_key, sighash)
 
             # Sum up the total inputs
             amount = tx_out.amount
@@ -217,45 +545,115 @@ class Node:
             out_sum += tx_out.amount
 
         # Check no value created or destroyed
-        assert in_sum >= out_sum
+        check(in_sum >= out_sum, "bad-amounts", "Outputs exceed inputs")
 
     def validate_coinbase(self, block):
         tx = block.txns[0]
-        assert len(tx.tx_ins) == len(tx.tx_outs) == 1
+        check(tx.is_coinbase and len(tx.tx_ins) == len(tx.tx_outs) == 1,
+              "bad-coinbase")
+        # Height makes each coinbase, and therefore its id, unique
+        check(tx.tx_ins[0].signature == encode_varint(len(self.blocks)),
+              "bad-coinbase-height")
         fees = self.calculate_fees(block.txns[1:])
-        assert tx.tx_outs[0].amount == self.get_block_subsidy() + fees
+        check(tx.tx_outs[0].amount == self.get_block_subsidy() + fees,
+              "bad-coinbase-amount")
+
+    def record_rejection(self, peer, reason):
+        self.peer_rejections[peer][reason] += 1
+
+    def handle_tx(self, tx, peer=None):
+        reason = self.rejected_txs.get(tx.id)
+        if reason:
+            self.record_rejection(peer, reason)
+            raise Rejected(reason, "Previously rejected tx")
 
-    def handle_tx(self, tx):
         if tx not in self.mempool:
-            self.validate_tx(tx)
+            try:
+                self.validate_tx(tx)
+            except Exception as e:
+                # Missing inputs may appear later, so those are forgotten
+                # when the tip moves. Bad sigs and amounts stay bad
+                reason = rejection_reason(e)
+                if reason:
+                    self.rejected_txs.add(tx.id, reason)
+                    self.record_rejection(peer, reason)
+                raise
             self.mempool.append(tx)
 
             # Propogate transaction
             for peer in self.peers:
                 send_message(peer, "tx", tx)
 
+    def already_seen(self, command, object_ids, peer=None):
+        # Checked against a message's inventory before its payload is decoded
+        if command in ("blocks", "cmpctblock"):
+            known = {block.id for block in self.blocks}
+            known.update(block.id for branch in self.branches for block in branch)
+            rejected = self.rejected_blocks
+        else:
+            known = {tx.id for tx in self.mempool}
+            rejected = self.rejected_txs
+        seen = True
+        for object_id in object_ids:
+            reason = rejected.get(object_id)
+            if reason:
+                self.record_rejection(peer, reason)
+            elif object_id not in known:
+                seen = False
+        return seen
+
     def validate_block(self, block, validate_txns=False):
-        assert block.proof < block.target, "Insufficient Proof-of-Work"
+        check(block.proof < block.target, "bad-pow",
+              "Insufficient Proof-of-Work")
 
         if validate_txns:
             # Check block timestamps cannot be too far in future
-            assert block.timestamp - time.time() < DIFFICULTY_PERIOD_IN_SECS,\
-                "Block too far in future"
+            check(block.timestamp - time.time() < DIFFICULTY_PERIOD_IN_SECS,
+                  "time-too-new", "Block too far in future")
 
             # Block timestamps must advance every block period
             height = max(len(self.blocks) - BLOCKS_PER_DIFFICULTY_PERIOD, 0)
-            assert block.timestamp > self.blocks[height].timestamp,\
-                "Block periods cannot go backwards in time"
+            check(block.timestamp > self.blocks[height].timestamp,
+                  "time-too-old", "Block periods cannot go backwards in time")
 
             # Check difficulty adjustment
-            assert block.bits == self.get_next_bits(block.prev_id, log=True)
+            check(block.bits == self.get_next_bits(block.prev_id, log=True),
+                  "bad-diffbits")
 
-            # Validate coinbase separately
-            self.validate_coinbase(block)
+            # History everyone already validated needs no signature checks
+            verify_signatures = block.id not in self.assumed_valid_ids
 
-            # Check the transactions are valid
+            # Check signatures in parallel, then stateful checks serially
+            if verify_signatures:
+                verify_block_signatures(block, self.utxo_set)
             for tx in block.txns[1:]:
-                self.validate_tx(tx)
+                self.validate_tx(tx, verify_signatures)
+
+            # Validate coinbase separately, once inputs are known to exist
+            self.validate_coinbase(block)
+
+    def reject_block(self, block, exception, peer=None):
+        reason = rejection_reason(exception)
+        if reason:
+            self.record_rejection(peer, reason)
+            if reason not in TRANSIENT_REJECTIONS:
+                self.rejected_blocks.add(block.id, reason)
+
+    def handle_headers(self, headers):
+        # Headers must hash-link from genesis to our assume-valid block, so
+        # block ids in this set are exactly its ancestors
+        block_ids = set()
+        prev_id = None
+        for header in headers:
+            check(read_id(io.BytesIO(header)) == prev_id, "bad-headers",
+                  "headers don't link")
+            prev_id = hashlib.sha256(header).hexdigest()
+            block_ids.add(prev_id)
+        check(prev_id == self.assume_valid, "bad-headers",
+              "headers don't reach assume-valid")
+
+        self.assumed_valid_ids = block_ids
+        logger.info(f"(assume-valid) Skipping signatures on {len(block_ids)} blocks")
 
     def find_in_branch(self, block_id):
         for branch_index, branch in enumerate(self.branches):
@@ -264,7 +662,16 @@ class Node:
                     return branch, branch_index, height
         return None, None, None
 
-    def handle_block(self, block):
+    def handle_block(self, block, peer=None):
+        # Don't revalidate blocks we know are invalid, or their descendants
+        reason = self.rejected_blocks.get(block.id)
+        if not reason and self.rejected_blocks.get(block.prev_id):
+            reason = "bad-prevblk"
+            self.rejected_blocks.add(block.id, reason)
+        if reason:
+            self.record_rejection(peer, reason)
+            raise Rejected(reason, "Previously rejected block")
+
         # Ignore if we've already seen it
         found_in_chain = block in self.blocks
         found_in_branch = self.find_in_branch(block.id)[0] is not None
@@ -282,7 +689,11 @@ class Node:
         forks_branch = branch and height != len(branch) - 1
 
         # Always validate, but only validate transactions if extending chain
-        self.validate_block(block, validate_txns=extends_chain)
+        try:
+            self.validate_block(block, validate_txns=extends_chain)
+        except Exception as e:
+            self.reject_block(block, e, peer)
+            raise
 
         # Handle each condition separately
         if extends_chain:
@@ -310,17 +721,59 @@ class Node:
             self.sync()
             raise Exception("Encountered block with unknown parent. Syncing.")
 
-        # Block propogation
+        # Block propogation, compact to peers holding our mempool's txns
+        compact = CompactBlock.from_block(block)
         for peer in self.peers:
-            disrupt(func=send_message, args=[peer, "blocks", [block]])
+            if self.peer_features.get(peer, 0) & FEATURE_COMPACT_BLOCKS:
+                disrupt(func=send_message, args=[peer, "cmpctblock", compact])
+            else:
+                disrupt(func=send_message, args=[peer, "blocks", [block]])
+
+    def find_block(self, block_id):
+        # Newest first, since peers mostly ask about the tip
+        for block in reversed(self.blocks):
+            if block.id == block_id:
+                return block
+        branch, _, height = self.find_in_branch(block_id)
+        return branch[height] if branch else None
+
+    def handle_compact_block(self, compact, peer=None):
+        # Returns indices of txns still needed, [] once the block is handled
+        txns = compact.reconstruct(self.mempool)
+        missing = [index for index, tx in enumerate(txns) if tx is None]
+        if not missing:
+            block = compact.to_block(txns)
+            if block.header == compact.header:
+                self.handle_block(block, peer)
+                return []
+
+            # A short id collision, so fetch everything we guessed
+            txns = compact.reconstruct([])
+            missing = [index for index, tx in enumerate(txns) if tx is None]
+
+        self.partial_blocks[compact.id] = (compact, txns)
+        self.partial_blocks.move_to_end(compact.id)
+        while len(self.partial_blocks) > PARTIAL_BLOCKS_SIZE:
+            self.partial_blocks.popitem(last=False)
+        return missing
+
+    def handle_block_txns(self, block_id, found, peer=None):
+        compact, txns = self.partial_blocks.pop(block_id)
+        missing = [index for index, tx in enumerate(txns) if tx is None]
+        for index, tx in zip(missing, found):
+            txns[index] = tx
+        block = compact.to_block(txns)
+        if len(found) != len(missing) or block.header != compact.header:
+            self.record_rejection(peer, "bad-blocktxn")
+            raise Rejected("bad-blocktxn", "Txns don't match the block header")
+        self.handle_block(block, peer)
 
     def reorg(self, branch, branch_index):
         # Disconnect to fork block, preserving as a branch
         disconnected_blocks = []
         while self.blocks[-1].id != branch[0].prev_id:
             block = self.blocks.pop()
-            for tx in block.txns:
-                self.disconnect_tx(tx)
+            self.disconnect_block(block)
             disconnected_blocks.insert(0, block)
 
         # Replace branch with newly disconnected blocks
@@ -331,19 +784,51 @@ class Node:
             try:
                 self.validate_block(block, validate_txns=True)
                 self.connect_block(block)
-            except:
+            except Exception as e:
+                self.reject_block(block, e)
                 self.reorg(disconnected_blocks, branch_index)
                 logger.info(f"Reorg failed")
                 return
 
     def connect_block(self, block):
-        # Add the block to our chain
-        self.blocks.append(block)
+        # Add the block to our chain, or just its header if it's stored
+        if self.store:
+            spent = [self.utxo_set[tx_in.outpoint]
+                     for tx in block.txns[1:] for tx_in in tx.tx_ins]
+            self.store.append(block, len(self.blocks), spent)
+            self.store.set_tip(block.id)
+            self.blocks.append(StoredBlock(self.store, block.header))
+        else:
+            self.blocks.append(block)
+
+        # Txs missing inputs before may be valid on the new tip
+        self.rejected_txs.forget("missing-input")
 
         # If they're all good, update UTXO set / mempool
         for tx in block.txns:
             self.connect_tx(tx)
 
+        if self.prune_depth:
+            self.prune()
+
+    def prune(self):
+        # Keep at least prune_depth blocks' bodies and undo data, for
+        # serving sync and reorging. The store snapshots the UTXO set
+        # first, since resume can't rebuild it from deleted bodies
+        segments = self.store.prunable(len(self.blocks) - self.prune_depth)
+        if segments:
+            self.store.prune(segments, self.blocks[-1].id,
+                             self.utxo_set.values())
+            logger.info(f"Pruned {len(segments)} block segments")
+
+    def disconnect_block(self, block):
+        # Stored undo data says what the inputs spent, else search the chain
+        spent = None
+        if self.store and block.id in self.store:
+            spent = iter(self.store.undo(block.id))
+        for tx in block.txns:
+            self.disconnect_tx(tx, spent)
+
     def get_block_subsidy(self):
         halvings = len(self.blocks) // HALVENING_INTERVAL
         return (50 * SATOSHIS_PER_COIN) // (2 ** halvings)
@@ -414,33 +899,33 @@ def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, f
     assert tx_in_sum >= amount + fee
 
     # Construct tx.tx_outs
-    tx_id = uuid.uuid4()
     change = tx_in_sum - (amount + fee)
     tx_outs = [
-        TxOut(tx_id=tx_id, index=0, amount=amount, public_key=recipient_public_key), 
-        TxOut(tx_id=tx_id, index=1, amount=change, public_key=sender_public_key),
+        TxOut(tx_id=None, index=0, amount=amount, public_key=recipient_public_key), 
+        TxOut(tx_id=None, index=1, amount=change, public_key=sender_public_key),
     ]
 
     # Construct tx and sign inputs
-    tx = Tx(id=tx_id, tx_ins=tx_ins, tx_outs=tx_outs)
+    tx = Tx(id=None, tx_ins=tx_ins, tx_outs=tx_outs)
+    sighash = SighashContext(tx)
     for i in range(len(tx.tx_ins)):
-        tx.sign_input(i, sender_private_key)
+        tx.sign_input(i, sender_private_key, sighash)
 
-    return tx
+    # Id is the hash of the signed tx
+    return tx.finalize()
 
-def prepare_coinbase(public_key, block_subsidy, tx_id=None):
-    if tx_id is None:
-        tx_id = uuid.uuid4()
-    return Tx(
-        id=tx_id,
+def prepare_coinbase(public_key, block_subsidy, height):
+    tx = Tx(
+        id=None,
         tx_ins=[
-            TxIn(None, None, None),    
+            TxIn(None, None, encode_varint(height)),
         ],
         tx_outs=[
-            TxOut(tx_id=tx_id, index=0, amount=block_subsidy,
+            TxOut(tx_id=None, index=0, amount=block_subsidy,
                   public_key=public_key),
         ],
     )
+    return tx.finalize()
 
 ##########
 # Mining #
@@ -457,184 +942,1454 @@ def mine_block(block):
     return block
 
 
+def with_node_state(func, *args):
+    # Node state is only touched on the runtime's executor. Without one
+    # (handlers called directly, as in tests), the lock serializes instead
+    if runtime:
+        return runtime.executor.submit(func, *args).result()
+    with lock:
+        return func(*args)
+
+def prepare_block_template(public_key):
+    block_subsidy = node.get_block_subsidy()
+    fees = node.calculate_fees(node.mempool)
+    coinbase = prepare_coinbase(public_key, block_subsidy + fees,
+                                len(node.blocks))
+    return Block(
+        txns=[coinbase] + node.mempool,
+        prev_id=node.blocks[-1].id,
+        nonce=random.randint(0, 1000000000),
+        bits=node.get_next_bits(node.blocks[-1].id),
+        timestamp=time.time(),
+    )
+
 def mine_forever(public_key):
     logging.info("Starting miner")
     while True:
-        block_subsidy = node.get_block_subsidy()
-        fees = node.calculate_fees(node.mempool)
-        coinbase = prepare_coinbase(public_key, block_subsidy + fees)
-        unmined_block = Block(
-            txns=[coinbase] + node.mempool,
-            prev_id=node.blocks[-1].id,
-            nonce=random.randint(0, 1000000000),
-            bits=node.get_next_bits(node.blocks[-1].id),
-            timestamp=time.time(),
-        )
+        unmined_block = with_node_state(prepare_block_template, public_key)
         mined_block = mine_block(unmined_block)
 
         if mined_block:
             logger.info("")
             logger.info("Mined a block")
-            with lock:
-                node.handle_block(mined_block)
+            with_node_state(node.handle_block, mined_block)
 
 def mine_genesis_block(node, public_key):
-    coinbase = prepare_coinbase(public_key, 
-            node.get_block_subsidy(), tx_id="abc123")
+    coinbase = prepare_coinbase(public_key, node.get_block_subsidy(), 0)
     unmined_block = Block(txns=[coinbase], prev_id=None, nonce=0,
             bits=INITIAL_DIFFICULTY_BITS, timestamp=1546383741.5890396)
     mined_block = mine_block(unmined_block)
-    node.blocks.append(mined_block)
-    node.connect_tx(coinbase)
+    node.connect_block(mined_block)
     return mined_block
 
-##############
-# Networking #
-##############
+#################
+# Serialization #
+#################
 
-def serialize(coin):
-    return pickle.dumps(coin)
+# Canonical little-endian encoding, independent of Python version and ecdsa
+# internals. Ids are 32 bytes, amounts 8 bytes, public keys 33 bytes
+# (compressed) and counts / indices / lengths are Bitcoin-style varints.
 
-def deserialize(serialized):
-    return pickle.loads(serialized)
+NULL_ID = bytes(32)
+NULL_INDEX = 0xffffffff
 
-def read_message(s):
-    message = b''
-    # Our protocol is: first 4 bytes signify message length
-    raw_message_length = s.recv(4) or b"\x00"
-    message_length = int.from_bytes(raw_message_length, 'big')
+def encode_varint(i):
+    if i < 0xfd:
+        return bytes([i])
+    elif i < 0x10000:
+        return b"\xfd" + i.to_bytes(2, "little")
+    elif i < 0x100000000:
+        return b"\xfe" + i.to_bytes(4, "little")
+    else:
+        return b"\xff" + i.to_bytes(8, "little")
+
+def read_exactly(s, n):
+    # A short read means the payload ended early, never an empty field
+    raw = s.read(n)
+    if len(raw) != n:
+        raise ProtocolError("Truncated payload")
+    return raw
+
+def read_count(s):
+    # Every item takes at least a byte, so checking a count against what's
+    # left stops a few bytes claiming billions of items
+    count = read_varint(s)
+    with s.getbuffer() as view:
+        if count > len(view) - s.tell():
+            raise ProtocolError(f"Count {count} exceeds payload")
+    return count
+
+VARINT_SIZES = {0xfd: (2, 0xfd), 0xfe: (4, 0x10000), 0xff: (8, 0x100000000)}
+
+def read_varint(s):
+    prefix = read_exactly(s, 1)[0]
+    if prefix not in VARINT_SIZES:
+        return prefix
+    # Only the shortest encoding is valid, else one tx could have many ids
+    size, minimum = VARINT_SIZES[prefix]
+    i = int.from_bytes(read_exactly(s, size), "little")
+    if i < minimum:
+        raise ProtocolError("Non-canonical varint")
+    return i
+
+def encode_bytes(b):
+    return encode_varint(len(b)) + b
+
+def read_bytes(s):
+    return read_exactly(s, read_varint(s))
+
+def encode_id(id):
+    return NULL_ID if id is None else bytes.fromhex(id)
+
+def read_id(s):
+    raw = read_exactly(s, 32)
+    return None if raw == NULL_ID else raw.hex()
+
+def encode_public_key(public_key):
+    point = public_key.pubkey.point
+    prefix = b"\x03" if point.y() & 1 else b"\x02"
+    return prefix + point.x().to_bytes(32, "big")
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def decode_public_key(raw):
+    # Interned: every decode of the same bytes shares one VerifyingKey, so a
+    # handful of hot keys build their verification tables once
+
+    # Recover y from x using the curve equation (p % 4 == 3 for secp256k1)
+    curve = SECP256k1.curve
+    p = curve.p()
+    x = int.from_bytes(raw[1:], "big")
+    if len(raw) != 33 or raw[0] not in (2, 3) or x >= p:
+        raise ProtocolError("Non-canonical public key")
+    y_squared = (pow(x, 3, p) + curve.a() * x + curve.b()) % p
+    y = pow(y_squared, (p + 1) // 4, p)
+    if y * y % p != y_squared:
+        raise ProtocolError("Public key not on curve")
+    if y & 1 != raw[0] & 1:
+        y = p - y
+    point = Point(curve, x, y, SECP256k1.order)
+    public_key = VerifyingKey.from_public_point(point, curve=SECP256k1)
+
+    # Older ecdsa releases can't precompute
+    if hasattr(public_key, "precompute"):
+        public_key.precompute(lazy=True)
+    return public_key
+
+def intern_public_key(public_key):
+    return decode_public_key(encode_public_key(public_key))
+
+def read_public_key(s):
+    return decode_public_key(read_exactly(s, 33))
+
+def encode_outpoint(tx_id, index):
+    index = NULL_INDEX if index is None else index
+    return encode_id(tx_id) + encode_varint(index)
+
+def encode_tx_in(tx_in):
+    signature = tx_in.signature or b""
+    return encode_outpoint(tx_in.tx_id, tx_in.index) + encode_bytes(signature)
+
+def read_tx_in(s):
+    tx_id = read_id(s)
+    index = read_varint(s)
+    signature = read_bytes(s) or None
+    if index == NULL_INDEX:
+        index = None
+    return TxIn(tx_id=tx_id, index=index, signature=signature)
+
+def encode_tx_out(tx_out):
+    # tx_id and index are implied by the enclosing Tx
+    return tx_out.amount.to_bytes(8, "little") + \
+        encode_public_key(tx_out.public_key)
+
+def encode_tx_outs(tx_outs):
+    return encode_varint(len(tx_outs)) + \
+        b"".join(encode_tx_out(tx_out) for tx_out in tx_outs)
+
+def read_tx_out(s, tx_id, index):
+    amount = int.from_bytes(read_exactly(s, 8), "little")
+    public_key = read_public_key(s)
+    return TxOut(tx_id=tx_id, index=index, amount=amount,
+                 public_key=public_key)
+
+def encode_tx_body(tx):
+    tx_ins = encode_varint(len(tx.tx_ins)) + \
+        b"".join(encode_tx_in(tx_in) for tx_in in tx.tx_ins)
+    return tx_ins + encode_tx_outs(tx.tx_outs)
+
+def encode_tx(tx):
+    # Ids aren't sent, receivers derive them from the contents
+    return encode_tx_body(tx)
+
+def compute_tx_id(tx):
+    return hashlib.sha256(encode_tx_body(tx)).hexdigest()
+
+def read_tx(s):
+    start = s.tell()
+    tx_ins = [read_tx_in(s) for _ in range(read_count(s))]
+    tx_outs = [read_tx_out(s, None, index)
+               for index in range(read_count(s))]
+    tx_id = hashlib.sha256(s.getbuffer()[start:s.tell()]).hexdigest()
+    for tx_out in tx_outs:
+        tx_out.tx_id = tx_id
+    return Tx(id=tx_id, tx_ins=tx_ins, tx_outs=tx_outs)
+
+def decode_tx(raw):
+    return read_tx(io.BytesIO(raw))
+
+def encode_utxo(tx_out):
+    # A TxOut travelling on its own (e.g. "utxos" responses)
+    return encode_outpoint(tx_out.tx_id, tx_out.index) + encode_tx_out(tx_out)
+
+def read_utxo(s):
+    tx_id = read_id(s)
+    index = read_varint(s)
+    return read_tx_out(s, tx_id, index)
+
+def decode_utxo(raw):
+    return read_utxo(io.BytesIO(raw))
+
+def txns_digest(txns):
+    # Tx ids are content hashes, so committing to them commits to the txns
+    return hashlib.sha256(b"".join(encode_id(tx.id) for tx in txns)).digest()
+
+def encode_block_header(block):
+    return encode_id(block.prev_id) + txns_digest(block.txns) + \
+        struct.pack("<BdQ", block.bits, block.timestamp, block.nonce)
+
+def read_block_header(s):
+    prev_id = read_id(s)
+    read_exactly(s, 32)     # txns digest
+    bits, timestamp, nonce = struct.unpack("<BdQ", read_exactly(s, 17))
+    return prev_id, bits, timestamp, nonce
+
+BLOCK_HEADER_SIZE = 32 + 32 + struct.calcsize("<BdQ")
+
+def short_id_key(header, salt):
+    # Salted per block, so nobody can mine txns whose short ids collide
+    return hashlib.sha256(header + salt.to_bytes(8, "little")).digest()[:16]
+
+def short_tx_id(key, tx_id):
+    return hashlib.blake2b(encode_id(tx_id), key=key,
+                           digest_size=SHORT_ID_SIZE).digest()
+
+def encode_block(block):
+    return encode_id(block.prev_id) + \
+        struct.pack("<BdQ", block.bits, block.timestamp, block.nonce) + \
+        encode_varint(len(block.txns)) + \
+        b"".join(encode_tx(tx) for tx in block.txns)
+
+def read_block(s):
+    prev_id = read_id(s)
+    bits, timestamp, nonce = struct.unpack("<BdQ", read_exactly(s, 17))
+    txns = [read_tx(s) for _ in range(read_count(s))]
+    return Block(txns=txns, prev_id=prev_id, nonce=nonce, bits=bits,
+                 timestamp=timestamp)
+
+def decode_block(raw):
+    return read_block(io.BytesIO(raw))
+
+def encode_compact_block(compact):
+    return compact.header + compact.salt.to_bytes(8, "little") + \
+        encode_varint(len(compact.short_ids)) + b"".join(compact.short_ids) + \
+        encode_varint(len(compact.prefilled)) + \
+        b"".join(encode_varint(index) + encode_tx(tx)
+                 for index, tx in compact.prefilled)
+
+def read_compact_block(s):
+    header = read_exactly(s, BLOCK_HEADER_SIZE)
+    salt = int.from_bytes(read_exactly(s, 8), "little")
+    short_ids = [read_exactly(s, SHORT_ID_SIZE)
+                 for _ in range(read_count(s))]
+    prefilled = [(read_varint(s), read_tx(s)) for _ in range(read_count(s))]
+    return CompactBlock(header, salt, short_ids, prefilled)
+
+###########
+# Storage #
+###########
+
+# Blocks are appended to numbered segment files, and never rewritten, each
+# followed by its undo data: the outputs its inputs spent, needed to
+# disconnect it again. An index of fixed-size records locates each one:
+#
+#   header (81) | segment (4) | offset (4) | length (4) | height (4) |
+#   undo length (4)
+#
+# and the chainstate file names the tip, which is replaced atomically.
+# Segment data (and a new segment's directory entry) is synced before its
+# index record, and the index before the tip, so whatever the tip names is
+# always on disk.
+#
+# Stored blocks are exactly their wire encoding, so they're served to peers
+# straight out of memory-mapped segments.
+#
+# Pruning deletes whole segments once every block in them is deep enough,
+# after snapshotting the UTXO set they built. The index keeps their headers,
+# so the chain itself is never forgotten.
+
+BLOCK_SEGMENT_SIZE = 16 * 1024 * 1024
+INDEX_RECORD_FORMAT = f">{BLOCK_HEADER_SIZE}sIIIII"
+INDEX_RECORD_SIZE = struct.calcsize(INDEX_RECORD_FORMAT)
+
+def fsync_write(f, data):
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+def fsync_directory(path):
+    # New files and renames are only durable once their directory is synced.
+    # Windows can't open directories, and doesn't need to
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class BlockStore:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.headers = {}               # id -> header
+        self.index = {}                 # id -> (segment, offset, length,
+                                        #        height, undo length)
+        self.segment_heights = {}       # segment -> height of its deepest
+                                        #            block from genesis
+        self.maps = {}                  # segment -> read-only mmap
+        self.bodies = OrderedDict()     # id -> Block, LRU
+        self.load_index()
+        self.index_file = open(self.file("index.dat"), "ab")
+        self.segment = max(self.segment_heights, default=0)
+        self.segment_file = open(self.segment_path(self.segment), "ab")
+        fsync_directory(self.path)
+        self.pruned = {segment for segment in self.segment_heights
+                       if not os.path.exists(self.segment_path(segment))}
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def segment_path(self, segment):
+        return self.file(f"blk{segment:05d}.dat")
+
+    def replace(self, name, data):
+        temp = self.file(name + ".tmp")
+        with open(temp, "wb") as f:
+            fsync_write(f, data)
+        os.replace(temp, self.file(name))
+        fsync_directory(self.path)
+
+    def load_index(self):
+        path = self.file("index.dat")
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            raw = f.read()
+        # Drop a record torn by a crash mid-append
+        complete = len(raw) - len(raw) % INDEX_RECORD_SIZE
+        if complete != len(raw):
+            with open(path, "r+b") as f:
+                f.truncate(complete)
+        for (header, *location) in struct.iter_unpack(INDEX_RECORD_FORMAT,
+                                                      raw[:complete]):
+            self.add(hashlib.sha256(header).hexdigest(), header,
+                     tuple(location))
+
+    def add(self, block_id, header, location):
+        segment, _, _, height, _ = location
+        self.headers[block_id] = header
+        self.index[block_id] = location
+        self.segment_heights[segment] = max(
+            height, self.segment_heights.get(segment, 0))
+
+    def __contains__(self, block_id):
+        return block_id in self.index
+
+    def has_body(self, block_id):
+        return block_id in self.index and \
+            self.index[block_id][0] not in self.pruned
+
+    def append(self, block, height, spent=()):
+        if block.id in self.index:
+            return
+        raw = encode_block(block)
+        undo = encode_list(encode_utxo, spent)
+        offset = self.segment_file.tell()
+        if offset and offset + len(raw) + len(undo) > BLOCK_SEGMENT_SIZE:
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+            # Else a crash could keep the index record but lose the segment
+            fsync_directory(self.path)
+            offset = 0
+        fsync_write(self.segment_file, raw + undo)
+        location = (self.segment, offset, len(raw), height, len(undo))
+        fsync_write(self.index_file, struct.pack(INDEX_RECORD_FORMAT,
+                                                 block.header, *location))
+        self.add(block.id, block.header, location)
+
+    def read(self, block_id):
+        segment, offset, length, _, _ = self.index[block_id]
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return decode_block(f.read(length))
+
+    def body(self, block_id):
+        # Decoded blocks, cached since reorgs and sync revisit recent ones
+        block = self.bodies.get(block_id)
+        if block is None:
+            block = self.read(block_id)
+            metrics["store.body_reads"] += 1
+        self.bodies[block_id] = block
+        self.bodies.move_to_end(block_id)
+        while len(self.bodies) > BLOCK_CACHE_SIZE:
+            self.bodies.popitem(last=False)
+        return block
+
+    def undo(self, block_id):
+        """The outputs a block's inputs spent, in order"""
+        segment, offset, length, _, undo_length = self.index[block_id]
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset + length)
+            return read_list(read_utxo, io.BytesIO(f.read(undo_length)))
+
+    def view(self, block_id):
+        """A block's encoding, as a memoryview of its mapped segment"""
+        segment, offset, length, _, _ = self.index[block_id]
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < offset + length:
+            # The segment grew since we mapped it. Views of the old map keep
+            # it alive until they're sent, so it's left for GC to unmap
+            with open(self.segment_path(segment), "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return memoryview(segment_map)[offset:offset + length]
+
+    def set_tip(self, block_id):
+        self.replace("chainstate", encode_id(block_id))
+
+    def tip(self):
+        try:
+            with open(self.file("chainstate"), "rb") as f:
+                return read_id(f)
+        except FileNotFoundError:
+            return None
+
+    def chain(self):
+        """Stored blocks from genesis to the tip, as headers"""
+        tip = self.tip()
+        if tip is None:
+            return []
+        height = self.index[tip][3]
+        blocks = [None] * (height + 1)
+        block_id = tip
+        for height in range(height, -1, -1):
+            block = blocks[height] = StoredBlock(self, self.headers[block_id])
+            block_id = block.prev_id
+        assert block_id is None, "Stored chain doesn't reach genesis"
+        return blocks
+
+    def prunable(self, height):
+        """Segments holding only blocks below this height"""
+        return [segment for segment, deepest in self.segment_heights.items()
+                if deepest < height and segment != self.segment
+                and segment not in self.pruned]
+
+    def prune(self, segments, tip, utxos):
+        """Deletes segments, once the UTXO set they built is safely saved"""
+        # replace() syncs the directory, so the new snapshot is durable
+        # before anything it replaces the need for is removed
+        self.save_utxos(tip, utxos)
+        for segment in segments:
+            # Frames still being sent may hold views of the map, so it's
+            # left for GC to unmap once they're gone, like a remapped one
+            self.maps.pop(segment, None)
+            os.remove(self.segment_path(segment))
+            self.pruned.add(segment)
+        fsync_directory(self.path)
+        self.bodies.clear()
+        metrics["store.pruned_segments"] += len(segments)
+
+    def save_utxos(self, tip, utxos):
+        self.replace("utxos.dat", encode_id(tip) +
+                     encode_list(encode_utxo, list(utxos)))
+
+    def load_utxos(self):
+        """The last UTXO set snapshot, and the tip it was taken at"""
+        try:
+            with open(self.file("utxos.dat"), "rb") as f:
+                s = io.BytesIO(f.read())
+            return read_id(s), read_list(read_utxo, s)
+        except FileNotFoundError:
+            return None, None
 
-    while message_length > 0:
-        chunk = s.recv(1024)
-        message += chunk
-        message_length -= len(chunk)
+    def close(self):
+        self.segment_file.close()
+        self.index_file.close()
 
-    return deserialize(message)
+##############
+# Networking #
+##############
 
-def prepare_message(command, data):
-    message = {
+# Every message is a fixed header followed by a typed payload:
+#
+#   magic (4) | version (1) | command id (1) | flags (1) | request id (4) |
+#   length (4) | checksum (4)
+#
+# The checksum is the first 4 bytes of sha256 of the payload as sent.
+# Responses carry their request's id, so clients can pipeline requests on
+# one connection and match replies in any order. 0 means no reply expected.
+#
+# Payloads of commands carrying txs or blocks start with an uncompressed
+# inventory of their ids, so receivers can drop objects they already have
+# without decoding (or decompressing) the rest:
+#
+#   count (2) | count * id (32) | body
+
+MAGIC = b"\xf9\xbe\xb4\xd9"
+PROTOCOL_VERSION = 5
+HEADER_FORMAT = ">4sBBBII4s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# Largest payload accepted per command, checked before any of it is read
+DEFAULT_PAYLOAD_LIMIT = 64 * 1024
+PAYLOAD_LIMITS = {
+    "tx": 100 * 1024,
+    "blocks": MAX_MESSAGE_SIZE,
+    "utxos-response": MAX_MESSAGE_SIZE,
+    "headers-response": MAX_MESSAGE_SIZE,
+    "cmpctblock": MAX_MESSAGE_SIZE,
+    "getblocktxn": MAX_MESSAGE_SIZE,    # may ask for every txn in a block
+    "blocktxn": MAX_MESSAGE_SIZE,
+}
+
+INVENTORY_COUNT_FORMAT = ">H"
+INVENTORY_COUNT_SIZE = struct.calcsize(INVENTORY_COUNT_FORMAT)
+
+# Header flags
+FLAG_COMPRESSED = 1
+FLAG_ACCEPTS_COMPRESSED = 2             # on requests: reply compressed
+
+# Feature bits exchanged during the "connect" handshake
+FEATURE_COMPRESSION = 1
+FEATURE_COMPACT_BLOCKS = 2
+FEATURE_PRUNED = 4                      # only has recent blocks' bodies
+FEATURES = FEATURE_COMPRESSION | FEATURE_COMPACT_BLOCKS
+
+COMPRESSION_THRESHOLD = 1024            # bytes, smaller payloads sent as-is
+COMPRESSION_LEVEL = 6
+
+CONNECT_TIMEOUT = 5                     # seconds
+REQUEST_TIMEOUT = 30                    # seconds to wait for a reply
+RECONNECT_BACKOFF = 0.5                 # doubles per failure ...
+MAX_RECONNECT_BACKOFF = 30              # ... up to this many seconds
+MAX_PIPELINED_REQUESTS = 64             # per connection, awaiting replies
+
+# Outbound priorities, lower is sent first. Unlisted commands are gossip
+PRIORITY_BLOCKS, PRIORITY_TXS, PRIORITY_GOSSIP = range(3)
+SEND_PRIORITIES = {
+    "connect": PRIORITY_BLOCKS,
+    "connect-response": PRIORITY_BLOCKS,
+    "sync": PRIORITY_BLOCKS,
+    "blocks": PRIORITY_BLOCKS,
+    "headers": PRIORITY_BLOCKS,
+    "headers-response": PRIORITY_BLOCKS,
+    "cmpctblock": PRIORITY_BLOCKS,
+    "getblocktxn": PRIORITY_BLOCKS,
+    "blocktxn": PRIORITY_BLOCKS,
+    "tx": PRIORITY_TXS,
+}
+OUTBOUND_QUEUE_SIZE = 1000              # messages waiting per peer
+
+PEER_NAME_TTL = 300                     # seconds a reverse DNS answer is trusted
+PEER_NAME_CACHE_SIZE = 1024
+
+# Counters / timers, e.g. metrics["compression.raw_bytes"]
+metrics = Counter()
+
+class ProtocolError(Exception):
+    pass
+
+class RequestError(Exception):
+    """A peer failed to handle our request, and replied with why"""
+
+def encode_list(encode_item, items):
+    return encode_varint(len(items)) + b"".join(encode_item(i) for i in items)
+
+def read_list(read_item, s):
+    return [read_item(s) for _ in range(read_count(s))]
+
+def encode_empty(data):
+    return b""
+
+def read_empty(s):
+    return None
+
+def encode_peer(peer):
+    host, port = peer
+    return encode_bytes(host.encode()) + port.to_bytes(2, "big")
+
+def read_peer(s):
+    host = read_bytes(s).decode()
+    return (host, int.from_bytes(read_exactly(s, 2), "big"))
+
+def encode_handshake(handshake):
+    features, name = handshake
+    return encode_varint(features) + encode_bytes(name.encode())
+
+def read_handshake(s):
+    return (read_varint(s), read_bytes(s).decode())
+
+def encode_amount(amount):
+    return amount.to_bytes(8, "little")
+
+def read_amount(s):
+    return int.from_bytes(read_exactly(s, 8), "little")
+
+# command -> (command id, payload encoder, payload reader)
+# Ids are part of the protocol: append new commands, never renumber
+CODECS = {
+    "connect": (0, encode_handshake, read_handshake),
+    "connect-response": (1, encode_handshake, read_handshake),
+    "peers": (2, encode_empty, read_empty),
+    "peers-response": (3, lambda peers: encode_list(encode_peer, peers),
+                       lambda s: read_list(read_peer, s)),
+    "ping": (4, encode_empty, read_empty),
+    "pong": (5, encode_empty, read_empty),
+    "sync": (6, lambda ids: encode_list(encode_id, ids),
+             lambda s: read_list(read_id, s)),
+    "blocks": (7, lambda blocks: encode_list(encode_block, blocks),
+               lambda s: read_list(read_block, s)),
+    "tx": (8, encode_tx, read_tx),
+    "balance": (9, encode_public_key, read_public_key),
+    "balance-response": (10, encode_amount, read_amount),
+    "utxos": (11, encode_public_key, read_public_key),
+    "utxos-response": (12, lambda utxos: encode_list(encode_utxo, utxos),
+                       lambda s: read_list(read_utxo, s)),
+    "headers": (13, encode_id, read_id),
+    "headers-response": (14, lambda headers: encode_list(encode_bytes, headers),
+                         lambda s: read_list(read_bytes, s)),
+    "cmpctblock": (15, encode_compact_block, read_compact_block),
+    "getblocktxn": (16, lambda request: encode_id(request[0]) +
+                        encode_list(encode_varint, request[1]),
+                    lambda s: (read_id(s), read_list(read_varint, s))),
+    "blocktxn": (17, lambda response: encode_id(response[0]) +
+                     encode_list(encode_tx, response[1]),
+                 lambda s: (read_id(s), read_list(read_tx, s))),
+    "error": (18, lambda message: encode_bytes(message.encode()),
+              lambda s: read_bytes(s).decode()),
+}
+COMMANDS = {command_id: command
+            for command, (command_id, _, _) in CODECS.items()}
+
+# command -> ids of the objects in its data
+INVENTORY = {
+    "tx": lambda tx: [tx.id],
+    "blocks": lambda blocks: [block.id for block in blocks],
+    "cmpctblock": lambda compact: [compact.id],
+}
+
+def payload_limit(command):
+    return PAYLOAD_LIMITS.get(command, DEFAULT_PAYLOAD_LIMIT)
+
+def encode_inventory(ids):
+    return struct.pack(INVENTORY_COUNT_FORMAT, len(ids)) + \
+        b"".join(encode_id(id) for id in ids)
+
+def inventory_size(count_bytes):
+    count, = struct.unpack(INVENTORY_COUNT_FORMAT, count_bytes)
+    return INVENTORY_COUNT_SIZE + 32 * count
+
+def read_inventory(s):
+    count, = struct.unpack(INVENTORY_COUNT_FORMAT,
+                           read_exactly(s, INVENTORY_COUNT_SIZE))
+    return [read_id(s) for _ in range(count)]
+
+def checksum(payload):
+    return hashlib.sha256(payload).digest()[:4]
+
+def compress(payload):
+    start_time = time.thread_time()
+    compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+    metrics["compression.messages"] += 1
+    metrics["compression.raw_bytes"] += len(payload)
+    metrics["compression.compressed_bytes"] += len(compressed)
+    metrics["compression.compress_secs"] += time.thread_time() - start_time
+    return compressed
+
+def decompress(payload, limit=MAX_MESSAGE_SIZE):
+    start_time = time.thread_time()
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(payload, limit)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ProtocolError("Compressed payload too large or truncated")
+    metrics["compression.decompress_secs"] += time.thread_time() - start_time
+    return raw
+
+def compression_ratio():
+    raw_bytes = metrics["compression.raw_bytes"]
+    return metrics["compression.compressed_bytes"] / raw_bytes if raw_bytes else 1
+
+def prepare_message(command, data, compressed=False, request_id=0, flags=0):
+    command_id, encode, _ = CODECS[command]
+    payload = encode(data)
+    if compressed and len(payload) > COMPRESSION_THRESHOLD:
+        candidate = compress(payload)
+        if len(candidate) < len(payload):
+            payload = candidate
+            flags |= FLAG_COMPRESSED
+    if command in INVENTORY:
+        payload = encode_inventory(INVENTORY[command](data)) + payload
+    return encode_header(command, flags, request_id, len(payload),
+                         checksum(payload)) + payload
+
+def encode_header(command, flags, request_id, length, check):
+    return struct.pack(HEADER_FORMAT, MAGIC, PROTOCOL_VERSION, CODECS[command][0],
+                       flags, request_id, length, check)
+
+def prepare_stored_blocks(store, block_ids):
+    """
+    A "blocks" message as a list of buffers, the blocks themselves being
+    views of the store's mapped segments, never decoded or re-encoded
+    """
+    parts = [encode_inventory(block_ids), encode_varint(len(block_ids))]
+    parts += [store.view(block_id) for block_id in block_ids]
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    length = sum(len(part) for part in parts)
+    return [encode_header("blocks", 0, 0, length, digest.digest()[:4])] + parts
+
+def decode_header(header):
+    magic, version, command_id, flags, request_id, length, check = \
+        struct.unpack(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise ProtocolError("Bad magic")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if command_id not in COMMANDS:
+        raise ProtocolError(f"Unknown command id {command_id}")
+    command = COMMANDS[command_id]
+    if length > payload_limit(command):
+        raise ProtocolError(f"{command} message too large ({length} bytes)")
+    if command in INVENTORY and length < INVENTORY_COUNT_SIZE:
+        raise ProtocolError(f"{command} message missing inventory")
+    return command, flags, request_id, length, check
+
+def check_inventory_size(command, size, length):
+    if size > length:
+        raise ProtocolError(f"{command} inventory larger than message")
+
+def decode_payload(command, flags, payload, check, request_id=0):
+    # Payload is a BytesIO, decoded in place without copying it out
+    with payload.getbuffer() as view:
+        if checksum(view) != check:
+            raise ProtocolError("Bad checksum")
+    payload.seek(0)
+    _, _, read = CODECS[command]
+    try:
+        ids = read_inventory(payload) if command in INVENTORY else None
+        if flags & FLAG_COMPRESSED:
+            with payload.getbuffer() as view:
+                body = view[payload.tell():]
+                payload = io.BytesIO(decompress(body, payload_limit(command)))
+                body.release()
+        length = len(payload.getbuffer())
+        data = read(payload)
+    except ProtocolError:
+        raise
+    except Exception as e:
+        # Readers trust their input to be well formed, so whatever they
+        # trip over (short reads, bad keys, bad UTF-8) means a bad peer
+        raise ProtocolError(f"Malformed {command} payload: {e!r}") from e
+    if payload.tell() != length:
+        raise ProtocolError(f"Trailing bytes in {command} payload")
+    if ids is not None and INVENTORY[command](data) != ids:
+        raise ProtocolError(f"{command} inventory doesn't match payload")
+    return {
         "command": command,
         "data": data,
+        "request_id": request_id,
+        "flags": flags,
     }
-    serialized_message = serialize(message)
-    length = len(serialized_message).to_bytes(4, 'big')
-    return length + serialized_message
+
+def allocate_buffer(length):
+    # Writing the last byte sizes the BytesIO in a single allocation
+    buffer = io.BytesIO()
+    if length:
+        buffer.seek(length - 1)
+        buffer.write(b"\x00")
+    return buffer
+
+def recv_into_exactly(s, view):
+    # Returns bytes received, fewer than len(view) only if the peer closed
+    received = 0
+    while received < len(view):
+        n = s.recv_into(view[received:])
+        if n == 0:
+            break
+        received += n
+    return received
+
+DISCARD_CHUNK = 64 * 1024
+
+def discard_exactly(s, length):
+    scratch = memoryview(bytearray(min(length, DISCARD_CHUNK)))
+    while length:
+        received = recv_into_exactly(s, scratch[:min(length, len(scratch))])
+        if received == 0:
+            raise ConnectionError("Socket closed mid-message")
+        length -= received
+
+def read_message(s, skip=None):
+    """
+    Next message on the socket, or None once the peer closes it. Messages
+    whose inventory skip(command, ids) rejects are discarded undecoded.
+    """
+    while True:
+        header = bytearray(HEADER_SIZE)
+        received = recv_into_exactly(s, memoryview(header))
+        if received == 0:
+            # Peer closed the connection between messages
+            return None
+        if received < HEADER_SIZE:
+            raise ConnectionError("Socket closed mid-message")
+        command, flags, request_id, length, check = decode_header(header)
+
+        # Receive the payload straight into the buffer we decode from
+        payload = allocate_buffer(length)
+        with payload.getbuffer() as view:
+            received = 0
+            if command in INVENTORY:
+                received = recv_into_exactly(s, view[:INVENTORY_COUNT_SIZE])
+                if received < INVENTORY_COUNT_SIZE:
+                    raise ConnectionError("Socket closed mid-message")
+                size = inventory_size(view[:INVENTORY_COUNT_SIZE])
+                check_inventory_size(command, size, length)
+                received += recv_into_exactly(s, view[received:size])
+                if received < size:
+                    raise ConnectionError("Socket closed mid-message")
+                if skip and skip(command, read_inventory(io.BytesIO(view[:size]))):
+                    metrics["messages.skipped"] += 1
+                    metrics["messages.skipped_bytes"] += length
+                    discard_exactly(s, length - received)
+                    continue
+            if recv_into_exactly(s, view[received:]) < length - received:
+                raise ConnectionError("Socket closed mid-message")
+        return decode_payload(command, flags, payload, check, request_id)
+
+def decode_message(raw):
+    command, flags, request_id, length, check = decode_header(raw[:HEADER_SIZE])
+    return decode_payload(command, flags, io.BytesIO(raw[HEADER_SIZE:]), check,
+                          request_id)
 
 def disrupt(func, args):
     # Simulate packet loss
     if random.randint(0, 10) != 0:
-        # Simulate network latency
-        threading.Timer(random.random(), func, args).start()
-
-class TCPHandler(socketserver.BaseRequestHandler):
-
-    def get_canonical_peer_address(self):
-        ip = self.client_address[0]
-        try:
-            hostname = socket.gethostbyaddr(ip)
-            hostname = re.search(r"_(.*?)_", hostname[0]).group(1)
-        except:
-            hostname = ip
-        return (hostname, PORT)
-
-    def respond(self, command, data):
-        response = prepare_message(command, data)
-        return self.request.sendall(response)
-
-    def handle(self):
-        message = read_message(self.request)
-        command = message["command"]
-        data = message["data"]
-
-        peer = self.get_canonical_peer_address()
-
-        # Handshake / Authentication
-        if command == "connect":
-            if peer not in node.pending_peers and peer not in node.peers:
+        # Simulate network latency, on the event loop rather than a thread each
+        if runtime:
+            runtime.call_later(random.random(), func, *args)
+        else:
+            threading.Timer(random.random(), func, args).start()
+
+def get_canonical_peer_address(ip):
+    try:
+        hostname = socket.gethostbyaddr(ip)
+        hostname = re.search(r"_(.*?)_", hostname[0]).group(1)
+    except:
+        hostname = ip
+    return (hostname, PORT)
+
+class PeerNameCache:
+    """
+    IP -> canonical peer address, so reverse DNS runs once per peer per TTL
+    rather than once per connection. With use_dns off, peers are known by
+    the name in their handshake and DNS is never consulted.
+    """
+
+    def __init__(self, ttl=PEER_NAME_TTL, maxsize=PEER_NAME_CACHE_SIZE,
+                 use_dns=True):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.use_dns = use_dns
+        self.entries = OrderedDict()    # ip -> (peer, expiry)
+        self.lock = threading.Lock()
+
+    def store(self, ip, peer, expiry):
+        with self.lock:
+            self.entries[ip] = (peer, expiry)
+            self.entries.move_to_end(ip)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def cached(self, ip):
+        with self.lock:
+            entry = self.entries.get(ip)
+        if entry and entry[1] > time.monotonic():
+            metrics["peer_names.hits"] += 1
+            return entry[0]
+        return None
+
+    def learn(self, ip, name):
+        # Handshake names are only trusted when DNS is switched off
+        if not self.use_dns:
+            self.store(ip, (name, PORT), float("inf"))
+
+    def lookup(self, ip):
+        peer = self.cached(ip)
+        if peer is None:
+            if not self.use_dns:
+                # Until they say who they are
+                return (ip, PORT)
+            metrics["peer_names.lookups"] += 1
+            peer = get_canonical_peer_address(ip)
+            self.store(ip, peer, time.monotonic() + self.ttl)
+        return peer
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+peer_names = PeerNameCache()
+
+def handle_message(command, data, peer, respond):
+    # Handshake / Authentication
+    if command == "connect":
+        with lock:
+            accepted = peer not in node.pending_peers and peer not in node.peers
+            if accepted:
                 node.pending_peers.append(peer)
-                logger.info(f'(handshake) Accepted "connect" request from "{peer[0]}"')
-                send_message(peer, "connect-response", None)
-        elif command == "connect-response":
-            if peer in node.pending_peers and peer not in node.peers:
+                node.peer_features[peer] = data[0]
+        if accepted:
+            logger.info(f'(handshake) Accepted "connect" request from "{peer[0]}"')
+            send_message(peer, "connect-response", (node.features, node.address[0]))
+    elif command == "connect-response":
+        with lock:
+            connected = peer in node.pending_peers and peer not in node.peers
+            if connected:
                 node.pending_peers.remove(peer)
                 node.peers.append(peer)
-                logger.info(f'(handshake) Connected to "{peer[0]}"')
-                send_message(peer, "connect-response", None)
-
-                # Request their peers
-                send_message(peer, "peers", None)
-            
-        # else:
-            # assert peer in node.peers, \
-                # f"Rejecting {command} from unconnected {peer[0]}"
-
-        # Business Logic
-        if command == "peers":
-            send_message(peer, "peers-response", node.peers)
-
-        if command == "peers-response":
-            for peer in data:
-                node.connect(peer)
-
-        if command == "ping":
-            self.respond(command="pong", data="")
-
-        if command == "sync":
-            # Find our most recent block peer doesn't know about,
-            # But which build off a block they do know about.
-            peer_block_ids = data
-            for block in node.blocks[::-1]:
+                node.peer_features[peer] = data[0]
+        if connected:
+            logger.info(f'(handshake) Connected to "{peer[0]}"')
+            send_message(peer, "connect-response", (node.features, node.address[0]))
+
+            # Request their peers
+            send_message(peer, "peers", None)
+        
+    # else:
+        # assert peer in node.peers, \
+            # f"Rejecting {command} from unconnected {peer[0]}"
+
+    # Business Logic
+    if command == "peers":
+        send_message(peer, "peers-response", list(node.peers))
+
+    if command == "peers-response":
+        for peer in data:
+            node.connect(peer)
+
+    if command == "ping":
+        respond(command="pong", data="")
+
+    if command == "sync":
+        # Find our most recent block peer doesn't know about,
+        # But which build off a block they do know about.
+        # The miner appends to (and prunes) the store under the lock
+        peer_block_ids = data
+        with lock:
+            blocks = list(node.blocks)
+            for block in blocks[::-1]:
                 if block.id not in peer_block_ids \
                         and block.prev_id in peer_block_ids:
-                    height = node.blocks.index(block)
-                    blocks = node.blocks[height:height+GET_BLOCKS_CHUNK]
-                    send_message(peer, "blocks", blocks)
+                    height = blocks.index(block)
+                    blocks = blocks[height:height+GET_BLOCKS_CHUNK]
+                    if node.store and not all(node.store.has_body(block.id)
+                                              for block in blocks):
+                        break
+                    if node.store:
+                        send_stored_blocks(peer,
+                                           [block.id for block in blocks])
+                    else:
+                        send_message(peer, "blocks", blocks)
                     logger.info('Served "sync" request')
                     return
 
-            logger.info('Could not serve "sync" request')
+        logger.info('Could not serve "sync" request')
 
-        if command == "blocks":
+    if command == "headers":
+        # Headers from genesis through the requested block
+        blocks = list(node.blocks)
+        block_ids = [block.id for block in blocks]
+        if data in block_ids:
+            height = block_ids.index(data)
+            headers = [block.header for block in blocks[:height+1]]
+            send_message(peer, "headers-response", headers)
 
-            for block in data:
-                try:
-                    with lock:
-                        node.handle_block(block)
-                    mining_interrupt.set()
-                except:
-                    logger.info("Rejected block")
+    if command == "headers-response":
+        if node.assume_valid and not node.assumed_valid_ids:
+            try:
+                with lock:
+                    node.handle_headers(data)
+            except Rejected as e:
+                logger.info(f"Rejected headers: {e}")
+
+    if command == "blocks":
+
+        for block in data:
+            try:
+                with lock:
+                    node.handle_block(block, peer)
+                mining_interrupt.set()
+            except Exception as e:
+                logger.info(f"Rejected block: {e}")
+
+        if len(data) == GET_BLOCKS_CHUNK:
+            node.sync()
 
-            if len(data) == GET_BLOCKS_CHUNK:
-                node.sync()
+    if command == "cmpctblock":
+        try:
+            with lock:
+                missing = node.handle_compact_block(data, peer)
+            if missing:
+                send_message(peer, "getblocktxn", (data.id, missing))
+            else:
+                mining_interrupt.set()
+        except Exception as e:
+            logger.info(f"Rejected compact block: {e}")
+
+    if command == "getblocktxn":
+        block_id, indices = data
+        with lock:
+            block = node.find_block(block_id)
+            if node.store and not node.store.has_body(block_id):
+                block = None
+            txns = block.txns if block else []
+        if block and all(index < len(txns) for index in indices):
+            send_message(peer, "blocktxn",
+                         (block_id, [txns[index] for index in indices]))
+
+    if command == "blocktxn":
+        try:
+            with lock:
+                node.handle_block_txns(*data, peer=peer)
+            mining_interrupt.set()
+        except Exception as e:
+            logger.info(f"Rejected block: {e}")
 
-        if command == "tx":
-            node.handle_tx(data)
+    if command == "tx":
+        try:
+            with lock:
+                node.handle_tx(data, peer)
+        except Exception as e:
+            logger.info(f"Rejected tx: {e}")
 
-        if command == "balance":
+    if command == "balance":
+        with lock:
             balance = node.fetch_balance(data)
-            self.respond(command="balance-response", data=balance)
+        respond(command="balance-response", data=balance)
 
-        if command == "utxos":
+    if command == "utxos":
+        with lock:
             utxos = node.fetch_utxos(data)
-            self.respond(command="utxos-response", data=utxos)
+        respond(command="utxos-response", data=utxos)
 
 def external_address(node):
     i = int(node[-1])
     port = PORT + i
     return ('localhost', port)
 
+DECODE_INLINE_LIMIT = 64 * 1024        # larger payloads decode off the loop
+
+async def read_into_exactly(reader, view):
+    # StreamReader can't read into a buffer, so copy chunks in as they come
+    received = 0
+    while received < len(view):
+        chunk = await reader.read(len(view) - received)
+        if not chunk:
+            raise ConnectionError("Socket closed mid-message")
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
+
+async def read_message_async(reader, skip=None):
+    # Same as read_message, with skip a coroutine function
+    while True:
+        try:
+            header = await reader.readexactly(HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                # Peer closed the connection between messages
+                return None
+            raise ConnectionError("Socket closed mid-message")
+        command, flags, request_id, length, check = decode_header(header)
+
+        # Receive the payload straight into the buffer we decode from
+        payload = allocate_buffer(length)
+        with payload.getbuffer() as view:
+            received = 0
+            if command in INVENTORY:
+                await read_into_exactly(reader, view[:INVENTORY_COUNT_SIZE])
+                size = inventory_size(view[:INVENTORY_COUNT_SIZE])
+                check_inventory_size(command, size, length)
+                await read_into_exactly(reader, view[INVENTORY_COUNT_SIZE:size])
+                received = size
+                if skip and await skip(command,
+                                       read_inventory(io.BytesIO(view[:size]))):
+                    metrics["messages.skipped"] += 1
+                    metrics["messages.skipped_bytes"] += length
+                    remaining = length - received
+                    try:
+                        while remaining:
+                            chunk = min(remaining, DISCARD_CHUNK)
+                            await reader.readexactly(chunk)
+                            remaining -= chunk
+                    except asyncio.IncompleteReadError:
+                        raise ConnectionError("Socket closed mid-message")
+                    continue
+            await read_into_exactly(reader, view[received:])
+
+        # Sync batches take a while to decode, so don't stall the loop
+        if length > DECODE_INLINE_LIMIT:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, decode_payload, command, flags, payload, check,
+                request_id)
+        return decode_payload(command, flags, payload, check, request_id)
+
+class OutboundQueue:
+    """
+    Bounded send queue for one peer, drained most important first. When
+    full, the oldest of the least important messages makes room, unless
+    everything queued matters more than the newcomer. Event loop only.
+    """
+
+    def __init__(self, max_size=OUTBOUND_QUEUE_SIZE):
+        self.max_size = max_size
+        self.queues = [deque() for _ in range(PRIORITY_GOSSIP + 1)]
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, priority, message):
+        if len(self) >= self.max_size:
+            metrics["outbound.dropped"] += 1
+            victim = max(p for p, queue in enumerate(self.queues) if queue)
+            if victim < priority:
+                return False
+            self.queues[victim].popleft()
+        self.queues[priority].append(message)
+        self.ready.set()
+        return True
+
+    async def get(self):
+        while not len(self):
+            self.ready.clear()
+            await self.ready.wait()
+        for queue in self.queues:
+            if queue:
+                return queue.popleft()
+
+class AsyncRuntime:
+    """asyncio server and client. Each connection is its own task, and node
+    state is only touched from one serialized executor thread"""
+
+    def __init__(self, node):
+        self.node = node
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="state")
+        self.server = None
+        self.ready = threading.Event()
+        self.inbound = set()
+        self.outbound = {}
+        self.queues = {}
+        self.senders = {}
+
+    def run(self, host="0.0.0.0", port=PORT):
+        # Serves forever, so call this from its own thread
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, host, port))
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def shutdown(self):
+        # Closing every connection lets their tasks finish on their own
+        self.server.close()
+        for sender in self.senders.values():
+            sender.cancel()
+        for writer in list(self.inbound) + list(self.outbound.values()):
+            writer.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+        self.executor.shutdown(wait=False)
+        shutdown_verify_pool()
+
+    async def handle_connection(self, reader, writer):
+        ip = writer.get_extra_info("peername")[0]
+        peer = None
+
+        def responder(request_id, compressed):
+            # Clients don't handshake, so they ask for compression per request
+            def respond(command, data):
+                response = prepare_message(command, data, compressed,
+                                           request_id)
+                self.loop.call_soon_threadsafe(writer.write, response)
+            return respond
+
+        # Pipelined requests are handled while we read on, up to a limit
+        in_flight = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+
+        def request_done(request_id, future):
+            in_flight.release()
+            if future.exception():
+                logger.info(f"Request from {ip} failed: {future.exception()!r}")
+                # Else the client waits on a reply that's never coming
+                writer.write(prepare_message("error", repr(future.exception()),
+                                             request_id=request_id))
+
+        async def resolve():
+            # Reverse DNS blocks, so keep a cache miss off the event loop
+            return peer_names.cached(ip) or await self.loop.run_in_executor(
+                None, peer_names.lookup, ip)
+
+        async def skip(command, ids):
+            nonlocal peer
+            peer = peer or await resolve()
+            return await self.loop.run_in_executor(self.executor,
+                self.node.already_seen, command, ids, peer)
+
+        self.inbound.add(writer)
+        try:
+            while True:
+                message = await read_message_async(reader, skip)
+                if message is None:
+                    break
+                command, data = message["command"], message["data"]
+                request_id = message["request_id"]
+                compressed = message["flags"] & FLAG_ACCEPTS_COMPRESSED
+
+                if command in ("connect", "connect-response"):
+                    peer_names.learn(ip, data[1])
+                    peer = None
+                peer = peer or await resolve()
+
+                # Cheap, stateless, never queued behind block validation
+                if command == "ping":
+                    writer.write(prepare_message("pong", "",
+                                                 request_id=request_id))
+                elif request_id:
+                    # The executor is FIFO, so ordering with gossip still holds
+                    await in_flight.acquire()
+                    self.loop.run_in_executor(self.executor, handle_message,
+                        command, data, peer, responder(request_id, compressed)
+                    ).add_done_callback(partial(request_done, request_id))
+                else:
+                    await self.loop.run_in_executor(self.executor,
+                        handle_message, command, data, peer,
+                        responder(0, compressed))
+                await writer.drain()
+        except (ConnectionError, ProtocolError) as e:
+            logger.info(f"Dropped connection from {ip}: {e}")
+        finally:
+            self.inbound.discard(writer)
+            writer.close()
+
+    def call_later(self, delay, func, *args):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, func, *args)
+
+    def send(self, address, command, data):
+        # Thread-safe and non-blocking, the peer's sender task does the I/O
+        features = self.node.peer_features.get(address, 0)
+        message = prepare_message(command, data,
+                                  compressed=features & FEATURE_COMPRESSION)
+        priority = SEND_PRIORITIES.get(command, PRIORITY_GOSSIP)
+        self.loop.call_soon_threadsafe(self.enqueue, address, priority, message)
+
+    def send_frame(self, address, command, frame):
+        # A message already encoded, possibly as a list of buffers
+        priority = SEND_PRIORITIES.get(command, PRIORITY_GOSSIP)
+        self.loop.call_soon_threadsafe(self.enqueue, address, priority, frame)
+
+    def enqueue(self, address, priority, message):
+        queue = self.queues.get(address)
+        if queue is None:
+            queue = self.queues[address] = OutboundQueue()
+            self.senders[address] = self.loop.create_task(
+                self.sender(address, queue))
+        queue.put(priority, message)
+
+    async def sender(self, address, queue):
+        # One per peer, so a slow peer only ever backs up its own queue
+        failures = 0
+        while True:
+            message = await queue.get()
+            writer = self.outbound.get(address)
+            try:
+                if writer is None or writer.is_closing():
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(*address), CONNECT_TIMEOUT)
+                    self.outbound[address] = writer
+                    metrics["connections.opened"] += 1
+                if isinstance(message, list):
+                    writer.writelines(message)
+                else:
+                    writer.write(message)
+                await writer.drain()
+                failures = 0
+            except (OSError, asyncio.TimeoutError) as e:
+                self.outbound.pop(address, None)
+                metrics["outbound.failed"] += 1
+                logger.info(f"Couldn't send to {address[0]}: {e!r}")
+                failures += 1
+
+            # Sent frames may be views of store segments, don't pin them
+            message = None
+
+            # Messages meanwhile wait in (or fall out of) the queue
+            if failures:
+                backoff = RECONNECT_BACKOFF * 2 ** (failures - 1)
+                await asyncio.sleep(min(backoff, MAX_RECONNECT_BACKOFF))
+
 def serve():
     logger.info("Starting server")
-    server = socketserver.TCPServer(("0.0.0.0", PORT), TCPHandler)
-    server.serve_forever()
+    runtime.run()
+
+class PeerConnection:
+    """
+    Long-lived socket to one address, reconnecting with backoff. Requests
+    are pipelined: a reader thread matches replies to them by request id.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.pending = {}               # request id -> Future, for self.sock
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retry_at = 0
+
+    def connect(self):
+        if time.time() < self.retry_at:
+            raise ConnectionError(f"Backing off from {self.address[0]}")
+        try:
+            self.sock = socket.create_connection(self.address,
+                                                 timeout=CONNECT_TIMEOUT)
+            self.sock.settimeout(None)
+            self.failures = 0
+            metrics["connections.opened"] += 1
+        except OSError:
+            self.failures += 1
+            backoff = RECONNECT_BACKOFF * 2 ** (self.failures - 1)
+            self.retry_at = time.time() + min(backoff, MAX_RECONNECT_BACKOFF)
+            raise
+        self.pending = {}
+        threading.Thread(target=self.read_replies, args=(self.sock, self.pending),
+                         name="replies", daemon=True).start()
+
+    def close(self):
+        # The reader thread may close it too, as soon as we shut it down
+        sock, self.sock = self.sock, None
+        if sock:
+            # Shutting down wakes the reader thread, which fails its requests
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def read_replies(self, sock, pending):
+        try:
+            while True:
+                reply = read_message(sock)
+                if reply is None:
+                    break
+                with self.lock:
+                    future = pending.pop(reply["request_id"], None)
+                if future and reply["command"] == "error":
+                    future.set_exception(RequestError(reply["data"]))
+                elif future:
+                    future.set_result(reply)
+        except (OSError, ProtocolError) as e:
+            logger.info(f"Connection to {self.address[0]} failed: {e!r}")
+        finally:
+            # Whatever stopped us, nothing still waiting may hang
+            with self.lock:
+                if self.sock is sock:
+                    self.close()
+                futures = list(pending.values())
+                pending.clear()
+            for future in futures:
+                future.set_exception(ConnectionError(
+                    f"Connection to {self.address[0]} closed before reply"))
+
+    def write(self, message):
+        # Called holding the lock, which keeps frames whole. A pooled socket
+        # may have gone stale, so retry once on a fresh one
+        for attempt in range(2):
+            if self.sock is None:
+                self.connect()
+            try:
+                self.sock.sendall(message)
+                return
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+    def send(self, message):
+        with self.lock:
+            self.write(message)
+
+    def request(self, command, data, compressed=False):
+        """Sends a request without waiting, returning a Future of the reply"""
+        future = Future()
+        with self.lock:
+            request_id = next(self.request_ids) % 0xffffffff + 1
+            self.write(prepare_message(command, data, compressed, request_id,
+                                       flags=FLAG_ACCEPTS_COMPRESSED))
+            self.pending[request_id] = future
+        return future
+
+class ConnectionPool:
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, address):
+        with self.lock:
+            if address not in self.connections:
+                self.connections[address] = PeerConnection(address)
+            return self.connections[address]
+
+pool = ConnectionPool()
+
+def send_stored_blocks(address, block_ids):
+    frame = prepare_stored_blocks(node.store, block_ids)
+    if runtime:
+        return runtime.send_frame(address, "blocks", frame)
+    return pool.get(address).send(b"".join(frame))
 
 def send_message(address, command, data, response=False):
-    message = prepare_message(command, data)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(address)
-        s.sendall(message)
-        if response:
-            return read_message(s)
+    # Nodes send through their event loop, CLI requests block on the pool
+    if runtime and not response:
+        return runtime.send(address, command, data)
+
+    # Only compress for peers which said they can decompress
+    features = node.peer_features.get(address, 0) if node else 0
+    compressed = features & FEATURE_COMPRESSION
+    if response:
+        return pool.get(address).request(command, data, compressed).result(
+            timeout=REQUEST_TIMEOUT)
+    return pool.get(address).send(prepare_message(command, data, compressed))
 
 
 #######
@@ -645,10 +2400,10 @@ def lookup_private_key(name):
     exponent = {
         "alice": 1, "bob": 2, "node0": 3, "node1": 4, "node2": 5
     }[name]
-    return SigningKey.from_secret_exponent(exponent, curve=SECP256k1)
+    return private_key_from_exponent(exponent)
 
 def lookup_public_key(name):
-    return lookup_private_key(name).get_verifying_key()
+    return intern_public_key(lookup_private_key(name).get_verifying_key())
 
 def main(args):
     if args["serve"]:
@@ -658,11 +2413,19 @@ def main(args):
         duration = 10 * ["node0", "node1", "node2"].index(name)
         time.sleep(duration)
 
-        global node
+        global node, runtime
         node = Node(address=(name, PORT))
-
-        # Alice is Satoshi!
-        mine_genesis_block(node, lookup_public_key("alice"))
+        runtime = AsyncRuntime(node)
+        if args["--assume-valid"] != "0":
+            node.assume_valid = args["--assume-valid"]
+        peer_names.use_dns = not args["--handshake-names"]
+        node.prune_depth = int(args["--prune"]) or None
+
+        # Pick up where we left off, else start over. Alice is Satoshi!
+        if node.resume(BlockStore(args["--datadir"])):
+            logger.info(f"Resumed chain at height {len(node.blocks) - 1}")
+        else:
+            mine_genesis_block(node, lookup_public_key("alice"))
 
         # Start server thread
         server_thread = threading.Thread(target=serve, name="server")
@@ -676,6 +2439,11 @@ def main(args):
         # Wait for peer connections
         time.sleep(1)
 
+        # Learn which blocks we can skip signature checks for
+        if node.assume_valid:
+            for peer in node.peers:
+                send_message(peer, "headers", node.assume_valid)
+
         # Do initial block download
         node.sync()
 
@@ -692,10 +2460,12 @@ def main(args):
         address = external_address(args["--node"])
         send_message(address, "ping", "")
     elif args["balance"]:
-        public_key = lookup_public_key(args["<name>"])
-        address = external_address(args["--node"])
-        response = send_message(address, "balance", public_key, response=True)
-        print(response["data"])
+        # Pipelined on one connection, replies matched up by request id
+        connection = pool.get(external_address(args["--node"]))
+        requests = [connection.request("balance", lookup_public_key(name))
+                    for name in args["<name>"]]
+        for request in requests:
+            print(request.result(timeout=REQUEST_TIMEOUT)["data"])
     elif args["tx"]:
         # Grab parameters
         sender_private_key = lookup_private_key(args["<from>"])
@@ -0,0 +1,880 @@
+import asyncio
+import io
+import os
+import time
+import socket
+import threading
+import pickle
+import pytest
+import ecdsa
+import bitcoin as b
+
+###########
+# Helpers #
+###########
+
+# Set difficulty very low
+b.INITIAL_DIFFICULTY_BITS = 2
+
+alice_private_key = b.lookup_private_key("alice")
+alice_public_key = alice_private_key.get_verifying_key()
+bob_private_key = b.lookup_private_key("bob")
+bob_public_key = bob_private_key.get_verifying_key()
+
+def make_node():
+    node = b.Node(address=("", b.PORT))
+    b.mine_genesis_block(node, alice_public_key)
+    return node
+
+def send_tx(node, sender_private_key, recipient_public_key, amount, fee=100):
+    utxos = node.fetch_utxos(sender_private_key.get_verifying_key())
+    return b.prepare_simple_tx(utxos, sender_private_key,
+                               recipient_public_key, amount, fee)
+
+def mine_block(node, miner_public_key, txns=()):
+    txns = list(txns)
+    fees = node.calculate_fees(txns)
+    coinbase = b.prepare_coinbase(miner_public_key,
+                                  node.get_block_subsidy() + fees,
+                                  len(node.blocks))
+    unmined_block = b.Block(
+        txns=[coinbase] + txns,
+        prev_id=node.blocks[-1].id,
+        nonce=0,
+        bits=node.get_next_bits(node.blocks[-1].id),
+        timestamp=time.time(),
+    )
+    return b.mine_block(unmined_block)
+
+#########
+# Tests #
+#########
+
+def test_extend_chain():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    node.handle_tx(tx)
+    block = mine_block(node, bob_public_key, [tx])
+    node.handle_block(block)
+
+    assert node.blocks[-1] == block
+    assert node.mempool == []
+    assert node.fetch_balance(bob_public_key) == \
+        node.get_block_subsidy() + 10 + 100
+
+def test_sig_cache():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    message = b.spend_message(tx, 0)
+    signature = tx.tx_ins[0].signature
+
+    # Mempool admission caches the verified signature ...
+    node.handle_tx(tx)
+    assert b.sig_cache.contains(message, signature, alice_public_key)
+
+    # ... but never a bad one
+    tx.tx_ins[0].signature = alice_private_key.sign(b"bad")
+    with pytest.raises(ecdsa.keys.BadSignatureError):
+        tx.verify_input(0, alice_public_key)
+    assert not b.sig_cache.contains(message, tx.tx_ins[0].signature,
+                                    alice_public_key)
+
+def test_sig_cache_bounded():
+    cache = b.SignatureCache(max_size=2)
+    for i in range(3):
+        cache.add(bytes([i]), b"sig", alice_public_key)
+    assert len(cache.entries) == 2
+    assert not cache.contains(bytes([0]), b"sig", alice_public_key)
+    assert cache.contains(bytes([2]), b"sig", alice_public_key)
+
+def test_parallel_verify(monkeypatch):
+    monkeypatch.setattr(b, "PARALLEL_VERIFY_THRESHOLD", 1)
+    monkeypatch.setattr(b, "sig_cache", b.SignatureCache())
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    block = mine_block(node, bob_public_key, [tx])
+
+    # Worker processes verify and the results land in our cache
+    b.verify_block_signatures(block, node.utxo_set)
+    message = b.spend_message(tx, 0)
+    assert b.sig_cache.contains(message, tx.tx_ins[0].signature,
+                                alice_public_key)
+
+    # Bad signatures are rejected
+    tx.tx_ins[0].signature = alice_private_key.sign(b"bad")
+    with pytest.raises(ecdsa.keys.BadSignatureError):
+        b.verify_block_signatures(block, node.utxo_set)
+
+    # Workers are spawned, never forked from a threaded node, and stopped
+    assert b.verify_pool._mp_context.get_start_method() == "spawn"
+    b.shutdown_verify_pool()
+    assert b.verify_pool is None
+
+    # Keys travel encoded, so workers decode them to their interned copy
+    pickled = []
+    class Pool:
+        def map(self, func, jobs, chunksize):
+            pickled.extend(len(pickle.dumps(job)) for job in jobs)
+            return map(func, jobs)
+    monkeypatch.setattr(b, "get_verify_pool", Pool)
+    tx = send_tx(node, alice_private_key, bob_public_key, 20)
+    b.verify_block_signatures(mine_block(node, bob_public_key, [tx]),
+                              node.utxo_set)
+    assert pickled and max(pickled) < 256
+
+def test_sighash_serializes_outputs_once(monkeypatch):
+    node = make_node()
+
+    # Give alice a handful of small utxos so her tx has many inputs
+    utxos = []
+    for i in range(5):
+        tx_out = b.TxOut(tx_id=f"{i:064x}", index=0, amount=100,
+                         public_key=alice_public_key)
+        node.utxo_set[tx_out.outpoint] = tx_out
+        utxos.append(tx_out)
+    tx = b.prepare_simple_tx(utxos, alice_private_key, bob_public_key,
+                             amount=350, fee=100)
+    assert len(tx.tx_ins) == 5
+
+    calls = []
+    encode_tx_outs = b.encode_tx_outs
+    def counting_encode_tx_outs(tx_outs):
+        calls.append(tx_outs)
+        return encode_tx_outs(tx_outs)
+    monkeypatch.setattr(b, "encode_tx_outs", counting_encode_tx_outs)
+    monkeypatch.setattr(b, "sig_cache", b.SignatureCache())
+
+    node.validate_tx(tx)
+    assert len(calls) == 1
+
+def test_canonical_encoding():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    block = mine_block(node, bob_public_key, [tx])
+
+    # Compressed public keys
+    raw = b.encode_public_key(bob_public_key)
+    assert len(raw) == 33
+    assert b.decode_public_key(raw) == bob_public_key
+
+    # Transactions round trip with their signatures intact
+    decoded = b.decode_tx(b.encode_tx(tx))
+    assert decoded.id == tx.id
+    assert decoded.tx_outs[1].outpoint == tx.tx_outs[1].outpoint
+    assert decoded.tx_outs[1].public_key == alice_public_key
+    decoded.verify_input(0, alice_public_key)
+
+    # Blocks keep their ids, and pickle through the compact encoding
+    decoded = b.decode_block(b.encode_block(block))
+    assert decoded.id == block.id
+    assert pickle.loads(pickle.dumps(block)).id == block.id
+    assert len(pickle.dumps(block)) < len(b.encode_block(block)) + 100
+
+    # Coinbase inputs survive too
+    assert decoded.txns[0].is_coinbase
+
+def test_content_hash_tx_ids():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+
+    # Ids are derived from contents, and outputs point back at them
+    assert tx.id == b.compute_tx_id(tx)
+    assert all(tx_out.tx_id == tx.id for tx_out in tx.tx_outs)
+
+    # Receivers derive the same id, so txs work as dict / set keys
+    decoded = b.decode_tx(b.encode_tx(tx))
+    assert decoded.id == tx.id
+    assert len({tx, decoded}) == 1
+
+    # Coinbases at different heights never collide
+    first = b.prepare_coinbase(bob_public_key, 100, 1)
+    second = b.prepare_coinbase(bob_public_key, 100, 2)
+    assert first.id != second.id
+
+    # Only canonical encodings decode, so a tx has exactly one id
+    raw = b.encode_tx(tx)
+    assert raw[0] == len(tx.tx_ins)
+    with pytest.raises(b.ProtocolError):
+        b.decode_tx(b"\xfd" + raw[0:1] + b"\x00" + raw[1:])
+    key = b.encode_public_key(bob_public_key)
+    for bad_key in (b"\x06" + key[1:], key[:1] + b"\xff" * 32):
+        with pytest.raises(b.ProtocolError):
+            b.decode_public_key(bad_key)
+
+def test_public_key_interning():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+
+    # Every decoded copy of a key is the same object
+    first = b.decode_tx(b.encode_tx(tx))
+    second = b.decode_tx(b.encode_tx(tx))
+    assert first.tx_outs[0].public_key is second.tx_outs[0].public_key
+    assert b.intern_public_key(bob_public_key) is first.tx_outs[0].public_key
+
+def test_signature_backends_interoperate():
+    pytest.importorskip("coincurve")
+    native = b.signatures.NativeBackend()
+    python = b.signatures.PythonBackend()
+    message = b"hello"
+
+    # Either backend verifies the other's signatures
+    python.verify(bob_public_key, native.sign(bob_private_key, message), message)
+    native.verify(bob_public_key, python.sign(bob_private_key, message), message)
+
+    with pytest.raises(ecdsa.keys.BadSignatureError):
+        native.verify(alice_public_key,
+                      python.sign(bob_private_key, message), message)
+
+def test_assume_valid(monkeypatch):
+    node = make_node()
+    for _ in range(3):
+        tx = send_tx(node, alice_private_key, bob_public_key, 10)
+        node.handle_tx(tx)
+        node.handle_block(mine_block(node, bob_public_key, [tx]))
+
+    # New node trusts history up to height 2
+    new_node = make_node()
+    new_node.assume_valid = node.blocks[2].id
+    new_node.handle_headers([block.header for block in node.blocks[:3]])
+
+    # Count signature checks, starting from a cold cache
+    verified = []
+    verify = b.verify
+    def counting_verify(*args):
+        verified.append(args)
+        return verify(*args)
+    monkeypatch.setattr(b, "verify", counting_verify)
+    monkeypatch.setattr(b, "sig_cache", b.SignatureCache())
+
+    # Ancestors skip ECDSA, later blocks are fully verified
+    new_node.handle_block(node.blocks[1])
+    new_node.handle_block(node.blocks[2])
+    assert verified == []
+    new_node.handle_block(node.blocks[3])
+    assert len(verified) == 1
+    assert new_node.utxo_set.keys() == node.utxo_set.keys()
+
+    # Headers must link, and reach the assume-valid block
+    for headers in ([block.header for block in node.blocks[:2]],
+                    [block.header for block in node.blocks[1:3]]):
+        with pytest.raises(b.Rejected) as e:
+            new_node.handle_headers(headers)
+        assert e.value.reason == "bad-headers"
+
+def test_rejected_block_cache(monkeypatch):
+    node = make_node()
+    monkeypatch.setattr(b, "sig_cache", b.SignatureCache())
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    tx.tx_ins[0].signature = alice_private_key.sign(b"bad")
+    block = mine_block(node, bob_public_key, [tx.finalize()])
+
+    peer = ("node1", b.PORT)
+    with pytest.raises(ecdsa.keys.BadSignatureError):
+        node.handle_block(block, peer)
+    assert node.rejected_blocks.get(block.id) == "bad-sig"
+
+    # Resending skips validation entirely
+    monkeypatch.setattr(node, "validate_block", None)
+    with pytest.raises(b.Rejected):
+        node.handle_block(block, peer)
+    assert node.peer_rejections[peer]["bad-sig"] == 2
+
+def test_rejected_tx_cache(monkeypatch):
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    tx.tx_ins[0].tx_id = "00" * 31 + "01"
+    tx.finalize()
+
+    with pytest.raises(b.Rejected) as e:
+        node.handle_tx(tx)
+    assert e.value.reason == "missing-input"
+    assert node.rejected_txs.get(tx.id) == "missing-input"
+
+    # Forgotten once the tip moves, unlike txs which can never be valid
+    node.rejected_txs.add("bad", "bad-sig")
+    node.handle_block(mine_block(node, bob_public_key))
+    assert node.rejected_txs.get(tx.id) is None
+    assert node.rejected_txs.get("bad") == "bad-sig"
+
+    # Unsigned inputs are bad sigs too, cached and held against the peer
+    for signature in (b"", b"\x01" * 10):
+        tx = send_tx(node, alice_private_key, bob_public_key, 10)
+        raw = b.encode_tx(tx)
+        tx = b.decode_tx(raw.replace(b.encode_bytes(tx.tx_ins[0].signature),
+                                     b.encode_bytes(signature)))
+        with pytest.raises(b.Rejected) as e:
+            node.handle_tx(tx, peer="mallory")
+        assert e.value.reason == "bad-sig"
+        assert node.rejected_txs.get(tx.id) == "bad-sig"
+    assert node.peer_rejections["mallory"]["bad-sig"] == 2
+
+    # ... including in blocks, whose signatures may be checked in parallel
+    monkeypatch.setattr(b, "PARALLEL_VERIFY_THRESHOLD", 1)
+    with pytest.raises(b.Rejected) as e:
+        node.handle_block(mine_block(node, bob_public_key, [tx]), "mallory")
+    assert e.value.reason == "bad-sig"
+
+def test_wire_codec():
+    node = make_node()
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    block = mine_block(node, bob_public_key, [tx])
+
+    def round_trip(command, data):
+        return b.decode_message(b.prepare_message(command, data))
+
+    message = round_trip("blocks", [block])
+    assert message["command"] == "blocks"
+    assert message["data"][0].id == block.id
+    assert round_trip("tx", tx)["data"].id == tx.id
+    assert round_trip("sync", [block.id])["data"] == [block.id]
+    assert round_trip("balance-response", 123)["data"] == 123
+    assert round_trip("peers-response", [("node1", 10000)])["data"] == \
+        [("node1", 10000)]
+    utxos = round_trip("utxos-response", node.fetch_utxos(alice_public_key))
+    assert utxos["data"][0].outpoint == node.blocks[0].txns[0].tx_outs[0].outpoint
+
+    # Corrupted payloads are caught by the checksum
+    raw = b.prepare_message("tx", tx)
+    with pytest.raises(b.ProtocolError):
+        b.decode_message(raw[:-1] + bytes([raw[-1] ^ 1]))
+
+    # ... and malformed ones with a valid checksum are protocol errors too
+    for command, payload in [("balance", b"\x02" + bytes(32)),
+                             ("tx", b"\x05"), ("error", b"\x01\xff"),
+                             ("balance-response", bytes(7)),
+                             ("sync", b"\x01" + bytes(31))]:
+        header = b.encode_header(command, 0, 0, len(payload),
+                                 b.checksum(payload))
+        with pytest.raises(b.ProtocolError):
+            b.decode_message(header + payload)
+
+    # Counts are checked against the payload before anything is allocated
+    payload = b"\xff" + (2 ** 62).to_bytes(8, "little") + bytes(19)
+    header = b.encode_header("sync", 0, 0, len(payload), b.checksum(payload))
+    with pytest.raises(b.ProtocolError, match="exceeds payload"):
+        b.decode_message(header + payload)
+
+def test_read_message():
+    node = make_node()
+    blocks = [mine_block(node, bob_public_key)]
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        # Messages arrive back to back on one connection
+        theirs.sendall(b.prepare_message("blocks", blocks) +
+                       b.prepare_message("ping", ""))
+        assert b.read_message(ours)["data"][0].id == blocks[0].id
+        assert b.read_message(ours)["command"] == "ping"
+
+        # Clean close between messages isn't a message
+        theirs.shutdown(socket.SHUT_WR)
+        assert b.read_message(ours) is None
+
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(b.prepare_message("blocks", blocks)[:-1])
+        theirs.shutdown(socket.SHUT_WR)
+        with pytest.raises(ConnectionError):
+            b.read_message(ours)
+
+    # The event loop reads the same way, decoding big payloads elsewhere
+    utxos = node.fetch_utxos(alice_public_key) * 1000
+    async def read_async(raw):
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await b.read_message_async(reader)
+    raw = b.prepare_message("utxos-response", utxos)
+    assert len(raw) > b.DECODE_INLINE_LIMIT
+    message = asyncio.run(read_async(raw))
+    assert len(message["data"]) == 1000
+    assert asyncio.run(read_async(b.prepare_message("blocks", blocks)))[
+        "data"][0].id == blocks[0].id
+    with pytest.raises(ConnectionError):
+        asyncio.run(read_async(raw[:-1]))
+
+def test_message_inventory(monkeypatch):
+    node = make_node()
+    old, new = mine_block(node, bob_public_key), mine_block(node, bob_public_key)
+    node.handle_block(old)
+
+    # Payloads of objects we already have are never decoded
+    decoded = []
+    read_block = b.read_block
+    monkeypatch.setitem(b.CODECS, "blocks", (7, b.CODECS["blocks"][1],
+        lambda s: decoded.append(1) or b.read_list(read_block, s)))
+    skipped = b.metrics["messages.skipped"]
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(b.prepare_message("blocks", [old], compressed=True) +
+                       b.prepare_message("blocks", [new]))
+        message = b.read_message(ours, skip=node.already_seen)
+    assert message["data"][0].id == new.id
+    assert decoded == [1]
+    assert b.metrics["messages.skipped"] == skipped + 1
+
+    # Known-invalid objects still count against the sender
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    node.rejected_txs.add(tx.id, "missing-input")
+    assert node.already_seen("tx", [tx.id], peer="mallory")
+    assert node.peer_rejections["mallory"]["missing-input"] == 1
+
+    # Inventories must describe the payload they precede
+    raw = b.prepare_message("blocks", [new])
+    header, payload = raw[:b.HEADER_SIZE], raw[b.HEADER_SIZE:]
+    payload = payload[:2] + b.encode_id(old.id) + payload[34:]
+    header = header[:-4] + b.checksum(payload)
+    with pytest.raises(b.ProtocolError):
+        b.decode_message(header + payload)
+
+    # Per-command size limits apply before anything is read
+    monkeypatch.setitem(b.PAYLOAD_LIMITS, "tx", 10)
+    with pytest.raises(b.ProtocolError):
+        b.decode_message(b.prepare_message("tx", tx))
+
+def test_compact_blocks():
+    sender, receiver = make_node(), make_node()
+    tx = send_tx(sender, alice_private_key, bob_public_key, 10)
+    block = mine_block(sender, bob_public_key, [tx])
+
+    compact = b.decode_message(b.prepare_message(
+        "cmpctblock", b.CompactBlock.from_block(block)))["data"]
+    assert compact.id == block.id
+    assert len(b.prepare_message("cmpctblock", compact)) < \
+        len(b.prepare_message("blocks", [block]))
+
+    # Txns we already have are filled in from the mempool
+    receiver.mempool.append(tx)
+    assert receiver.handle_compact_block(compact) == []
+    assert receiver.blocks[-1].id == block.id
+
+    # Otherwise we ask for just the ones we're missing
+    receiver = make_node()
+    assert receiver.handle_compact_block(compact) == [1]
+    receiver.handle_block_txns(block.id, [block.txns[1]])
+    assert receiver.blocks[-1].id == block.id
+
+    # The header commits to the txns, so wrong ones are caught
+    receiver = make_node()
+    receiver.handle_compact_block(compact, peer="mallory")
+    other = send_tx(sender, alice_private_key, bob_public_key, 20)
+    with pytest.raises(b.Rejected):
+        receiver.handle_block_txns(block.id, [other], peer="mallory")
+    assert receiver.peer_rejections["mallory"]["bad-blocktxn"] == 1
+
+    # Short ids must be whole, and there can't be more than fit
+    raw = b.prepare_message("cmpctblock", compact)
+    for payload in [raw[b.HEADER_SIZE:-40],
+                    raw[b.HEADER_SIZE:b.HEADER_SIZE + 34 + 89] + b"\xfe" +
+                    (2 ** 31).to_bytes(4, "little")]:
+        header = b.encode_header("cmpctblock", 0, 0, len(payload),
+                                 b.checksum(payload))
+        with pytest.raises(b.ProtocolError):
+            b.decode_message(header + payload)
+
+    # Requests for every txn of a big block still fit in a message
+    request = (block.id, list(range(30000)))
+    assert b.decode_message(b.prepare_message("getblocktxn", request))[
+        "data"] == request
+
+def test_compression():
+    node = make_node()
+    blocks = [mine_block(node, bob_public_key) for _ in range(20)]
+
+    # Only when asked, and only above the size threshold
+    raw = b.prepare_message("blocks", blocks)
+    compressed = b.prepare_message("blocks", blocks, compressed=True)
+    assert len(compressed) < len(raw)
+    assert b.decode_message(compressed)["data"][-1].id == blocks[-1].id
+    assert b.prepare_message("ping", "", compressed=True) == \
+        b.prepare_message("ping", "")
+    assert b.metrics["compression.raw_bytes"] > 0
+    assert b.compression_ratio() < 1
+
+def start_runtime(node, monkeypatch):
+    monkeypatch.setattr(b, "node", node)
+    runtime = b.AsyncRuntime(node)
+    threading.Thread(target=runtime.run, args=("127.0.0.1", 0),
+                     daemon=True).start()
+    runtime.ready.wait()
+    return runtime, runtime.server.sockets[0].getsockname()
+
+def test_connection_pool(monkeypatch):
+    node = make_node()
+    runtime, address = start_runtime(node, monkeypatch)
+    monkeypatch.setattr(b, "pool", b.ConnectionPool())
+    opened = b.metrics["connections.opened"]
+
+    # Many messages, one connection
+    for _ in range(5):
+        response = b.send_message(address, "balance", alice_public_key,
+                                  response=True)
+        assert response["data"] == node.get_block_subsidy()
+    assert b.metrics["connections.opened"] == opened + 1
+
+    # Stale connections are replaced transparently
+    b.pool.get(address).sock.shutdown(socket.SHUT_RDWR)
+    assert b.send_message(address, "ping", "", response=True)["command"] == "pong"
+    assert b.metrics["connections.opened"] == opened + 2
+    runtime.stop()
+
+def test_pipelined_requests(monkeypatch):
+    node = make_node()
+    runtime, address = start_runtime(node, monkeypatch)
+    connection = b.PeerConnection(address)
+    opened = b.metrics["connections.opened"]
+
+    # Many requests in flight on one connection
+    requests = [connection.request("balance", key)
+                for key in [alice_public_key, bob_public_key] * 20]
+    balances = [request.result(timeout=5)["data"] for request in requests]
+    assert balances == [node.get_block_subsidy(), 0] * 20
+    assert b.metrics["connections.opened"] == opened + 1
+
+    # Replies come back out of order, and still find their request
+    fetch_balance = node.fetch_balance
+    def slow_fetch_balance(public_key):
+        time.sleep(0.2)
+        return fetch_balance(public_key)
+    monkeypatch.setattr(node, "fetch_balance", slow_fetch_balance)
+    balance = connection.request("balance", alice_public_key)
+    pong = connection.request("ping", "")
+    assert pong.result(timeout=5)["command"] == "pong"
+    assert not balance.done()
+    assert balance.result(timeout=5)["data"] == node.get_block_subsidy()
+
+    # Requests the node fails to handle fail here too, rather than hang
+    def broken_fetch_balance(public_key):
+        raise KeyError("broken")
+    monkeypatch.setattr(node, "fetch_balance", broken_fetch_balance)
+    with pytest.raises(b.RequestError, match="broken"):
+        connection.request("balance", alice_public_key).result(timeout=5)
+    assert connection.request("ping", "").result(timeout=5)["command"] == "pong"
+
+    # Requests outstanding when the connection drops fail rather than hang
+    balance = connection.request("balance", alice_public_key)
+    connection.close()
+    with pytest.raises(ConnectionError):
+        balance.result(timeout=5)
+    runtime.stop()
+
+def test_compressed_replies(monkeypatch):
+    node = make_node()
+    for i in range(100):
+        tx_out = b.TxOut(tx_id=f"{i:064x}", index=0, amount=1000,
+                         public_key=bob_public_key)
+        node.utxo_set[tx_out.outpoint] = tx_out
+    runtime, address = start_runtime(node, monkeypatch)
+
+    # Requests which ask for it get big replies compressed ...
+    def utxos_reply(flags):
+        with socket.create_connection(address) as s:
+            s.sendall(b.prepare_message("utxos", bob_public_key,
+                                        request_id=1, flags=flags))
+            header = b.decode_header(s.recv(b.HEADER_SIZE, socket.MSG_WAITALL))
+            return header[1] & b.FLAG_COMPRESSED
+    assert utxos_reply(b.FLAG_ACCEPTS_COMPRESSED)
+    assert not utxos_reply(0)
+
+    # ... which clients always do
+    reply = b.PeerConnection(address).request("utxos", bob_public_key)
+    assert len(reply.result(timeout=5)["data"]) == 100
+    assert reply.result()["flags"] & b.FLAG_COMPRESSED
+    runtime.stop()
+
+def test_connection_backoff(monkeypatch):
+    monkeypatch.setattr(b, "pool", b.ConnectionPool())
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        address = s.getsockname()
+
+    # Nothing listening, so we back off rather than hammering connect
+    with pytest.raises(ConnectionRefusedError):
+        b.send_message(address, "ping", "")
+    with pytest.raises(ConnectionError, match="Backing off"):
+        b.send_message(address, "ping", "")
+
+def test_async_runtime(monkeypatch):
+    node = make_node()
+    runtime, address = start_runtime(node, monkeypatch)
+    monkeypatch.setattr(b, "pool", b.ConnectionPool())
+
+    # Node state changes run on the serialized executor thread
+    handled = []
+    def handle_tx(tx, peer=None):
+        handled.append(threading.current_thread().name)
+    monkeypatch.setattr(node, "handle_tx", handle_tx)
+
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    b.send_message(address, "tx", tx)
+
+    # Pings are answered straight from the event loop, even while busy
+    assert b.send_message(address, "ping", "", response=True)["command"] == "pong"
+    balance = b.send_message(address, "balance", alice_public_key, response=True)
+    assert balance["data"] == node.get_block_subsidy()
+    assert handled and handled[0].startswith("state")
+
+    # Txs already in the mempool are dropped before decoding
+    node.mempool.append(tx)
+    skipped = b.metrics["messages.skipped"]
+    b.send_message(address, "tx", tx)
+    assert b.send_message(address, "ping", "", response=True)["command"] == "pong"
+    assert b.metrics["messages.skipped"] == skipped + 1
+    assert len(handled) == 1
+
+    # Clients opening many connections are all served concurrently
+    clients = [socket.create_connection(address) for _ in range(50)]
+    for client in clients:
+        client.sendall(b.prepare_message("ping", ""))
+    for client in clients:
+        assert b.read_message(client)["command"] == "pong"
+        client.close()
+
+    # The miner reads and extends the chain on the same executor thread
+    monkeypatch.setattr(b, "runtime", runtime)
+    mined = []
+    def handle_block(block):
+        mined.append(threading.current_thread().name)
+    monkeypatch.setattr(node, "handle_block", handle_block)
+    block = b.with_node_state(b.prepare_block_template, bob_public_key)
+    assert block.prev_id == node.blocks[-1].id
+    b.with_node_state(node.handle_block, block)
+    assert mined[0].startswith("state")
+    runtime.stop()
+
+def test_peer_name_cache(monkeypatch):
+    lookups = []
+    def gethostbyaddr(ip):
+        lookups.append(ip)
+        return (f"bitcoin_node{len(lookups)}_1.bitcoin_default", [], [ip])
+    monkeypatch.setattr(socket, "gethostbyaddr", gethostbyaddr)
+
+    # Reverse DNS once per ip, until the entry expires
+    names = b.PeerNameCache(ttl=60)
+    assert names.lookup("10.0.0.1") == ("node1", b.PORT)
+    assert names.lookup("10.0.0.1") == ("node1", b.PORT)
+    assert lookups == ["10.0.0.1"]
+    names.store("10.0.0.1", ("node1", b.PORT), time.monotonic() - 1)
+    assert names.lookup("10.0.0.1") == ("node2", b.PORT)
+    assert len(lookups) == 2
+
+    # Handshake names are ignored while DNS is authoritative ...
+    names.learn("10.0.0.2", "mallory")
+    assert names.lookup("10.0.0.2") == ("node3", b.PORT)
+
+    # ... and replace it entirely when it is switched off
+    names = b.PeerNameCache(use_dns=False)
+    assert names.lookup("10.0.0.3") == ("10.0.0.3", b.PORT)
+    names.learn("10.0.0.3", "node0")
+    assert names.lookup("10.0.0.3") == ("node0", b.PORT)
+    assert len(lookups) == 3
+
+def test_handshake_names(monkeypatch):
+    node = make_node()
+    runtime, address = start_runtime(node, monkeypatch)
+    monkeypatch.setattr(b, "pool", b.ConnectionPool())
+    monkeypatch.setattr(b, "peer_names", b.PeerNameCache(use_dns=False))
+    monkeypatch.setattr(socket, "gethostbyaddr", None)
+    sent = []
+    monkeypatch.setattr(b, "send_message",
+                        lambda peer, command, data, **kw: sent.append(peer))
+
+    client = socket.create_connection(address)
+    client.sendall(b.prepare_message("connect", (b.FEATURES, "node7")))
+    client.sendall(b.prepare_message("ping", ""))
+    assert b.read_message(client)["command"] == "pong"
+    client.close()
+    runtime.stop()
+
+    assert node.pending_peers == [("node7", b.PORT)]
+    assert sent == [("node7", b.PORT)]
+
+def test_outbound_queue():
+    async def drain(queue):
+        return [await queue.get() for _ in range(len(queue))]
+
+    queue = b.OutboundQueue(max_size=3)
+    queue.put(b.PRIORITY_GOSSIP, "peers")
+    queue.put(b.PRIORITY_TXS, "tx1")
+    queue.put(b.PRIORITY_BLOCKS, "block1")
+    assert asyncio.run(drain(queue)) == ["block1", "tx1", "peers"]
+
+    # Full queues shed gossip first, then the oldest tx, never for gossip
+    queue.put(b.PRIORITY_GOSSIP, "peers")
+    queue.put(b.PRIORITY_TXS, "tx1")
+    queue.put(b.PRIORITY_TXS, "tx2")
+    dropped = b.metrics["outbound.dropped"]
+    assert queue.put(b.PRIORITY_BLOCKS, "block1")
+    assert queue.put(b.PRIORITY_TXS, "tx3")
+    assert not queue.put(b.PRIORITY_GOSSIP, "peers")
+    assert b.metrics["outbound.dropped"] == dropped + 3
+    assert asyncio.run(drain(queue)) == ["block1", "tx2", "tx3"]
+
+def test_simulator():
+    import simulator
+    runtime, disrupt = b.runtime, b.disrupt
+    simulation = simulator.Simulation(nodes=12, topology="ring", latency=0.2,
+                                      jitter=0.2, block_time=0.5, seed=1)
+    results = simulation.run(blocks=20)
+
+    # Everyone ends up on the same chain, having seen all of it
+    assert results["converged"]
+    assert results["blocks_mined"] == 20
+    assert 0 < results["propagation_50"] <= results["propagation_100"]
+    assert results["height"] + results["orphan_rate"] * 20 == pytest.approx(20)
+    chain = simulation.nodes[("node0", b.PORT)].blocks[1:]
+    assert all(len(simulation.arrivals[block.id]) == 12 for block in chain)
+
+    # A ring six hops across with this latency forks, and then reorgs
+    assert results["reorgs"] and results["max_reorg_depth"] >= 1
+
+    # bitcoin.py is left as it was found
+    assert (b.runtime, b.disrupt, b.time) == (runtime, disrupt, time)
+
+    # Messages on the same link queue for its bandwidth
+    simulation = simulator.Simulation(nodes=3, topology="full", latency=0,
+                                      jitter=0, bandwidth=1000)
+    start = simulation.clock.now
+    with simulation.installed():
+        b.node = simulation.nodes[("node0", b.PORT)]
+        for peer in ["node1", "node1", "node2"]:
+            simulation.send((peer, b.PORT), "ping", "")
+    arrivals = [event[0] - start for event in sorted(simulation.events)[-3:]]
+    transmit = b.HEADER_SIZE / 1000
+    assert arrivals == pytest.approx([transmit, transmit, 2 * transmit],
+                                     abs=1e-5)
+
+def test_block_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(b, "BLOCK_SEGMENT_SIZE", 1000)
+    synced = []
+    fsync_directory = b.fsync_directory
+    monkeypatch.setattr(b, "fsync_directory",
+                        lambda path: synced.append(path) or fsync_directory(path))
+    node = b.Node(address=("", b.PORT))
+    node.resume(b.BlockStore(str(tmpdir)))
+    b.mine_genesis_block(node, alice_public_key)
+    for _ in range(5):
+        tx = send_tx(node, alice_private_key, bob_public_key, 10)
+        node.handle_block(mine_block(node, bob_public_key, [tx]))
+    node.store.close()
+
+    # Segments roll over, and the index knows where everything went
+    assert len(tmpdir.listdir("blk*.dat")) > 1
+
+    # New segments and each new tip are durable in the directory too
+    assert synced.count(str(tmpdir)) >= len(tmpdir.listdir("blk*.dat")) + 6
+
+    # A restarted node is back where it was without any peers
+    restarted = b.Node(address=("", b.PORT))
+    assert restarted.resume(b.BlockStore(str(tmpdir))) == 6
+    assert [block.id for block in restarted.blocks] == \
+        [block.id for block in node.blocks]
+    assert restarted.fetch_balance(bob_public_key) == \
+        node.fetch_balance(bob_public_key)
+
+    # ... and keeps storing, even after a crash tore the last index record
+    restarted.store.close()
+    with open(str(tmpdir.join("index.dat")), "ab") as f:
+        f.write(b"\x00" * 10)
+    restarted = b.Node(address=("", b.PORT))
+    restarted.resume(b.BlockStore(str(tmpdir)))
+    restarted.handle_block(mine_block(restarted, bob_public_key))
+    assert len(b.BlockStore(str(tmpdir)).chain()) == 7
+
+def test_stored_blocks_served_raw(tmpdir):
+    node = b.Node(address=("", b.PORT))
+    node.resume(b.BlockStore(str(tmpdir)))
+    b.mine_genesis_block(node, alice_public_key)
+    for _ in range(3):
+        tx = send_tx(node, alice_private_key, bob_public_key, 10)
+        node.handle_block(mine_block(node, bob_public_key, [tx]))
+
+    # Byte for byte what encoding the live blocks would send
+    block_ids = [block.id for block in node.blocks]
+    frame = b.prepare_stored_blocks(node.store, block_ids)
+    assert b"".join(frame) == b.prepare_message("blocks", node.blocks)
+    assert any(isinstance(part, memoryview) for part in frame)
+
+    # Segments are remapped as they grow
+    node.handle_block(mine_block(node, bob_public_key))
+    message = b.decode_message(b"".join(
+        b.prepare_stored_blocks(node.store, [node.blocks[-1].id])))
+    assert message["data"][0].id == node.blocks[-1].id
+
+def test_header_only_chain(tmpdir, monkeypatch):
+    monkeypatch.setattr(b, "BLOCK_CACHE_SIZE", 2)
+    node = b.Node(address=("", b.PORT))
+    node.resume(b.BlockStore(str(tmpdir)))
+    b.mine_genesis_block(node, alice_public_key)
+    other = make_node()
+
+    tx = send_tx(node, alice_private_key, bob_public_key, 10)
+    node.handle_tx(tx)
+    node.handle_block(mine_block(node, bob_public_key, [tx]))
+
+    # Only headers stay resident, bodies come back from disk when needed
+    assert all(isinstance(block, b.StoredBlock) for block in node.blocks)
+    assert not any("txns" in vars(block) for block in node.blocks)
+    assert node.blocks[-1].txns[1].id == tx.id
+    assert len(node.store.bodies) <= 2
+
+    # Reorgs disconnect using stored undo data, not a search of every body
+    monkeypatch.setattr(b, "tx_in_to_tx_out", None)
+    for _ in range(2):
+        block = mine_block(other, bob_public_key)
+        other.handle_block(block)
+        node.handle_block(block)
+    assert node.blocks[-1].id == other.blocks[-1].id
+    assert node.utxo_set.keys() == other.utxo_set.keys()
+    assert node.mempool == [tx]
+
+def test_pruned_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(b, "BLOCK_SEGMENT_SIZE", 1000)
+    node = b.Node(address=("", b.PORT))
+    node.prune_depth = 3
+    node.resume(b.BlockStore(str(tmpdir)))
+    events = []
+    fsync_directory, remove = b.fsync_directory, os.remove
+    monkeypatch.setattr(b, "fsync_directory",
+                        lambda path: events.append(("sync", os.listdir(path)))
+                        or fsync_directory(path))
+    monkeypatch.setattr(os, "remove",
+                        lambda path: events.append("remove") or remove(path))
+    b.mine_genesis_block(node, alice_public_key)
+    queued = b.prepare_stored_blocks(node.store, [node.blocks[0].id])
+    for _ in range(8):
+        tx = send_tx(node, alice_private_key, bob_public_key, 10)
+        node.handle_block(mine_block(node, bob_public_key, [tx]))
+    balance = node.fetch_balance(bob_public_key)
+
+    # Frames queued before a prune still send what they viewed
+    assert b.decode_block(bytes(queued[-1])).id == node.blocks[0].id
+
+    # Deep segments are gone, recent bodies and every header remain
+    assert node.store.pruned
+    assert not node.store.has_body(node.blocks[0].id)
+    assert all(node.store.has_body(block.id) for block in node.blocks[-3:])
+    assert len(node.store.chain()) == 9
+
+    # They're only removed once a directory sync made the snapshot durable
+    first_remove = events.index("remove")
+    assert events[first_remove - 1][0] == "sync"
+    assert "utxos.dat" in events[first_remove - 1][1]
+
+    # Peers are told, and only get blocks we still have
+    assert node.features & b.FEATURE_PRUNED
+    sent = []
+    monkeypatch.setattr(b, "node", node)
+    monkeypatch.setattr(b, "send_stored_blocks",
+                        lambda peer, block_ids: sent.append(block_ids))
+    b.handle_message("sync", [node.blocks[0].id], ("peer", b.PORT), None)
+    b.handle_message("sync", [node.blocks[-3].id], ("peer", b.PORT), None)
+    assert sent == [[block.id for block in node.blocks[-2:]]]
+    node.store.close()
+
+    # Restarts rebuild the UTXO set from the snapshot plus recent bodies
+    restarted = b.Node(address=("", b.PORT))
+    restarted.prune_depth = 3
+    assert restarted.resume(b.BlockStore(str(tmpdir))) == 9
+    assert restarted.fetch_balance(bob_public_key) == balance
+    restarted.handle_block(mine_block(restarted, bob_public_key))
+    assert restarted.blocks[-1].txns[0].tx_outs[0].public_key == bob_public_key
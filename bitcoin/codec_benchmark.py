@@ -0,0 +1,75 @@
+"""
+Compare the wire codec against pickling messages the way nodes used to
+
+Usage:
+  python codec_benchmark.py
+"""
+
+import io, pickle, time
+import bitcoin as b
+
+ITERATIONS = 200
+
+def restore(cls, state):
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+def legacy_reduce(obj):
+    # Plain object pickling, VerifyingKeys and all, bypassing __reduce__
+    return (restore, (type(obj), obj.__dict__))
+
+def pickle_dumps(command, data):
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f)
+    pickler.dispatch_table = {cls: legacy_reduce
+                              for cls in (b.Tx, b.TxIn, b.TxOut, b.Block)}
+    pickler.dump({"command": command, "data": data})
+    return f.getvalue()
+
+def rate(func, arg):
+    start_time = time.time()
+    for _ in range(ITERATIONS):
+        func(*arg)
+    return ITERATIONS / (time.time() - start_time)
+
+def sample_messages():
+    private_key = b.lookup_private_key("alice")
+    public_key = b.lookup_public_key("bob")
+    utxos = [b.TxOut(tx_id=f"{i:064x}", index=0, amount=1000,
+                     public_key=private_key.get_verifying_key())
+             for i in range(400)]
+
+    # 200 two-input txs, grouped into a 10 block "sync" batch
+    txns = [b.prepare_simple_tx(utxos[i:i+2], private_key, public_key,
+                                amount=1500, fee=100)
+            for i in range(0, 400, 2)]
+    blocks = [b.Block(txns=[b.prepare_coinbase(public_key, 50, height)]
+                      + txns[height*20:(height+1)*20],
+                      prev_id=f"{height:064x}", nonce=0, bits=20,
+                      timestamp=time.time())
+              for height in range(10)]
+
+    return [
+        ("tx", txns[0]),
+        ("blocks", blocks),
+        ("utxos-response", utxos),
+        ("sync", [block.id for block in blocks]),
+    ]
+
+def main():
+    for command, data in sample_messages():
+        codec_raw = b.prepare_message(command, data)
+        pickle_raw = pickle_dumps(command, data)
+        print(f"{command}:")
+        print(f"  size    codec {len(codec_raw):>9,} B   "
+              f"pickle {len(pickle_raw):>9,} B")
+        print(f"  zlib    codec {len(b.prepare_message(command, data, True)):>9,} B")
+        print(f"  encode  codec {rate(b.prepare_message, (command, data)):>9.0f}/s   "
+              f"pickle {rate(pickle_dumps, (command, data)):>9.0f}/s")
+        print(f"  decode  codec {rate(b.decode_message, (codec_raw,)):>9.0f}/s   "
+              f"pickle {rate(pickle.loads, (pickle_raw,)):>9.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
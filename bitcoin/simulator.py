@@ -0,0 +1,351 @@
+"""
+Simulate a network of nodes in one process, on a virtual clock
+
+Usage:
+  simulator.py [options]
+
+Options:
+  -h --help              Show this screen.
+  --nodes=<n>            Number of nodes [default: 100]
+  --topology=<kind>      random, ring, star or full [default: random]
+  --degree=<d>           Peers per node in random topologies [default: 8]
+  --latency=<secs>       One-way delay of every message [default: 0.1]
+  --bandwidth=<B/s>      Per-link bandwidth, 0 for unlimited [default: 1000000]
+  --jitter=<secs>        Extra random delay, up to this much [default: 0.1]
+  --loss=<p>             Chance each message is dropped [default: 0]
+  --block-time=<secs>    Mean time between blocks, network wide [default: 1]
+  --blocks=<n>           Blocks to mine before letting the network settle [default: 100]
+  --txs=<n>              Transactions broadcast while mining [default: 0]
+  --seed=<n>             Random seed [default: 0]
+  --full-blocks          Relay whole blocks rather than compact blocks
+"""
+
+import heapq, itertools, logging, random, statistics, time
+
+from docopt import docopt
+import bitcoin as b
+
+START_TIME = 1_600_000_000              # virtual seconds, after genesis
+
+# Hash power is modelled by the virtual clock rather than real hashing, so
+# proof-of-work is kept trivial and difficulty never retargets
+SIMULATION_DIFFICULTY_BITS = 2
+SIMULATION_DIFFICULTY_PERIOD = 10 ** 9
+
+
+class VirtualClock:
+    """Stands in for the time module inside bitcoin.py"""
+
+    def __init__(self, start=START_TIME):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+    def __getattr__(self, name):
+        # thread_time and friends still measure real CPU
+        return getattr(time, name)
+
+
+class SimulatedNode(b.Node):
+
+    def __init__(self, address, simulation):
+        super().__init__(address)
+        self.simulation = simulation
+        self.reorging = False
+
+    def reorg(self, branch, branch_index):
+        # Only count the reorg itself, not a rollback after a bad branch
+        if not self.reorging:
+            chain_ids = [block.id for block in self.blocks]
+            depth = len(chain_ids) - 1 - chain_ids.index(branch[0].prev_id)
+            self.simulation.reorgs.append(depth)
+        reorging, self.reorging = self.reorging, True
+        try:
+            super().reorg(branch, branch_index)
+        finally:
+            self.reorging = reorging
+
+
+def build_topology(n, kind="random", degree=8, rng=random):
+    """Returns each node's set of neighbours, always connected"""
+    neighbours = [set() for _ in range(n)]
+
+    def link(i, j):
+        if i != j:
+            neighbours[i].add(j)
+            neighbours[j].add(i)
+
+    if kind == "full":
+        for i, j in itertools.combinations(range(n), 2):
+            link(i, j)
+    elif kind == "star":
+        for i in range(1, n):
+            link(0, i)
+    elif kind in ("ring", "random"):
+        for i in range(n):
+            link(i, (i + 1) % n)
+        if kind == "random":
+            # A ring keeps it connected, random links make it small-world
+            for i in range(n):
+                while len(neighbours[i]) < min(degree, n - 1):
+                    link(i, rng.randrange(n))
+    else:
+        raise ValueError(f"Unknown topology {kind}")
+    return neighbours
+
+
+class Simulation:
+    """
+    N nodes exchanging real wire messages through a virtual network. It
+    stands in for the AsyncRuntime (send / call_later), so nodes run the
+    same handle_message / handle_block code as under serve.
+    """
+
+    def __init__(self, nodes=100, topology="random", degree=8, latency=0.1,
+                 jitter=0.1, loss=0, block_time=1, seed=0, compact=True,
+                 bandwidth=None, txs=0):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.link_busy = {}             # (source, address) -> time the link
+                                        #   finishes what's queued on it
+        self.jitter = jitter
+        self.loss = loss
+        self.block_time = block_time
+        self.clock = VirtualClock()
+        self.events = []                # (time, seq, func, args) heap
+        self.sequence = itertools.count()
+
+        self.nodes = {}
+        self.miner_keys = {}
+        self.mined = {}                 # block id -> time mined
+        self.arrivals = {}              # block id -> {address: first seen}
+        self.reorgs = []
+        self.stats = {"messages": 0, "bytes": 0, "dropped": 0, "skipped": 0}
+
+        with self.installed():
+            genesis = b.encode_block(self.mine_genesis_block(txs))
+            for i in range(nodes):
+                address = (f"node{i}", b.PORT)
+                node = SimulatedNode(address, self)
+                block = b.decode_block(genesis)
+                node.blocks.append(block)
+                node.connect_tx(block.txns[0])
+                self.nodes[address] = node
+                self.miner_keys[address] = b.intern_public_key(
+                    b.private_key_from_exponent(1000 + i).get_verifying_key())
+
+        # Peers are connected as if they'd already been through the handshake
+        features = b.FEATURES if compact else \
+            b.FEATURES & ~b.FEATURE_COMPACT_BLOCKS
+        addresses = list(self.nodes)
+        for i, peers in enumerate(build_topology(nodes, topology, degree, self.rng)):
+            node = self.nodes[addresses[i]]
+            node.peers = [addresses[j] for j in sorted(peers)]
+            node.peer_features = {peer: features for peer in node.peers}
+
+    def installed(self):
+        return Installed(self)
+
+    def mine_genesis_block(self, outputs):
+        # Pays alice one output per tx we'll broadcast, so none conflict
+        coinbase = b.prepare_coinbase(b.lookup_public_key("alice"),
+                                      b.Node(address=None).get_block_subsidy(), 0)
+        tx_out = coinbase.tx_outs[0]
+        coinbase.tx_outs = [b.TxOut(tx_id=None, index=i,
+                                    amount=tx_out.amount // max(outputs, 1),
+                                    public_key=tx_out.public_key)
+                            for i in range(max(outputs, 1))]
+        coinbase.finalize()
+        self.wallet = list(coinbase.tx_outs[:outputs])
+        return b.mine_block(b.Block(txns=[coinbase], prev_id=None, nonce=0,
+                                    bits=b.INITIAL_DIFFICULTY_BITS,
+                                    timestamp=START_TIME))
+
+    def schedule(self, delay, func, *args):
+        heapq.heappush(self.events,
+                       (self.clock.now + delay, next(self.sequence), func, args))
+
+    def call_later(self, delay, func, *args):
+        self.schedule(delay, func, *args)
+
+    def send(self, address, command, data):
+        # Called by whichever node is handling an event
+        source = b.node.address
+        raw = b.prepare_message(command, data)
+        self.stats["messages"] += 1
+        self.stats["bytes"] += len(raw)
+        if self.rng.random() < self.loss:
+            self.stats["dropped"] += 1
+            return
+        # Messages on one link queue behind each other for its bandwidth
+        sent = self.clock.now
+        if self.bandwidth:
+            link = (source, address)
+            sent = max(sent, self.link_busy.get(link, 0)) + \
+                len(raw) / self.bandwidth
+            self.link_busy[link] = sent
+        delay = sent - self.clock.now + self.latency + \
+            self.rng.uniform(0, self.jitter)
+        self.schedule(delay, self.deliver, source, address, raw)
+
+    def deliver(self, source, address, raw):
+        node = b.node = self.nodes[address]
+        command, *_ = b.decode_header(raw[:b.HEADER_SIZE])
+
+        # Check the inventory first, as the runtime does
+        if command in b.INVENTORY:
+            ids = b.read_inventory(b.io.BytesIO(raw[b.HEADER_SIZE:]))
+            if command in ("blocks", "cmpctblock"):
+                for block_id in ids:
+                    self.arrivals[block_id].setdefault(address, self.clock.now)
+            if node.already_seen(command, ids, source):
+                self.stats["skipped"] += 1
+                return
+
+        message = b.decode_message(raw)
+        respond = lambda command, data: self.send(source, command, data)
+        b.handle_message(message["command"], message["data"], source, respond)
+
+    def broadcast(self, address, utxo):
+        node = b.node = self.nodes[address]
+        tx = b.prepare_simple_tx([utxo], b.lookup_private_key("alice"),
+                                 b.lookup_public_key("bob"),
+                                 utxo.amount - 1000, fee=1000)
+        try:
+            node.handle_tx(tx)
+        except Exception:
+            pass
+
+    def mine(self, address):
+        node = b.node = self.nodes[address]
+        txns = list(node.mempool)
+        coinbase = b.prepare_coinbase(self.miner_keys[address],
+                                      node.get_block_subsidy() +
+                                      node.calculate_fees(txns),
+                                      len(node.blocks))
+        block = b.Block(txns=[coinbase] + txns,
+                        prev_id=node.blocks[-1].id, nonce=0,
+                        bits=node.get_next_bits(node.blocks[-1].id),
+                        timestamp=self.clock.now)
+        b.mining_interrupt.clear()
+        block = b.mine_block(block)
+        self.mined[block.id] = self.clock.now
+        self.arrivals[block.id] = {address: self.clock.now}
+        node.handle_block(block)
+
+    def schedule_mining(self, blocks):
+        # Poisson block arrivals, each found by a uniformly random node
+        at = 0
+        addresses = list(self.nodes)
+        for _ in range(blocks):
+            at += self.rng.expovariate(1 / self.block_time)
+            self.schedule(at, self.mine, self.rng.choice(addresses))
+
+    def schedule_txs(self, duration):
+        # Spread over the mining period, each from a random node
+        addresses = list(self.nodes)
+        for utxo in self.wallet:
+            self.schedule(self.rng.uniform(0, duration), self.broadcast,
+                          self.rng.choice(addresses), utxo)
+
+    def run(self, blocks=100):
+        with self.installed():
+            self.schedule_mining(blocks)
+            self.schedule_txs(blocks * self.block_time)
+            while self.events:
+                when, _, func, args = heapq.heappop(self.events)
+                self.clock.now = when
+                func(*args)
+        return self.report()
+
+    def report(self):
+        tips = {node.blocks[-1].id for node in self.nodes.values()}
+        chain = {block.id for block in
+                 max(self.nodes.values(), key=lambda n: len(n.blocks)).blocks}
+        n = len(self.nodes)
+
+        def time_to_reach(fraction):
+            times = []
+            for block_id, mined_at in self.mined.items():
+                seen = sorted(self.arrivals[block_id].values())
+                k = max(int(fraction * n), 1)
+                if len(seen) >= k:
+                    times.append(seen[k - 1] - mined_at)
+            return times
+
+        reach_half, reach_90, reach_all = (time_to_reach(f)
+                                           for f in (0.5, 0.9, 1))
+        stale = [block_id for block_id in self.mined if block_id not in chain]
+        return {
+            "nodes": n,
+            "blocks_mined": len(self.mined),
+            "converged": len(tips) == 1,
+            "height": len(chain) - 1,
+            "propagation_50": statistics.median(reach_half) if reach_half else None,
+            "propagation_90": statistics.median(reach_90) if reach_90 else None,
+            "propagation_100": max(reach_all) if reach_all else None,
+            "orphan_rate": len(stale) / len(self.mined) if self.mined else 0,
+            "reorgs": len(self.reorgs),
+            "max_reorg_depth": max(self.reorgs, default=0),
+            "virtual_secs": self.clock.now - START_TIME,
+            **self.stats,
+        }
+
+
+class Installed:
+    """Points bitcoin.py's globals at the simulation, restoring them after"""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def __enter__(self):
+        self.saved = {name: getattr(b, name) for name in
+                      ("node", "runtime", "time", "disrupt",
+                       "INITIAL_DIFFICULTY_BITS", "BLOCKS_PER_DIFFICULTY_PERIOD")}
+        b.runtime = self.simulation
+        b.time = self.simulation.clock
+        # Latency and loss come from the simulated network instead
+        b.disrupt = lambda func, args: func(*args)
+        b.INITIAL_DIFFICULTY_BITS = SIMULATION_DIFFICULTY_BITS
+        b.BLOCKS_PER_DIFFICULTY_PERIOD = SIMULATION_DIFFICULTY_PERIOD
+        # Per-message INFO logs from hundreds of nodes would swamp the results
+        self.disabled = logging.root.manager.disable
+        logging.disable(logging.INFO)
+
+    def __exit__(self, *exc_info):
+        for name, value in self.saved.items():
+            setattr(b, name, value)
+        logging.disable(self.disabled)
+        # Relayed blocks leave it set, which would stop the next mine_block
+        b.mining_interrupt.clear()
+
+
+def main(args):
+    simulation = Simulation(
+        nodes=int(args["--nodes"]),
+        topology=args["--topology"],
+        degree=int(args["--degree"]),
+        latency=float(args["--latency"]),
+        bandwidth=float(args["--bandwidth"]),
+        jitter=float(args["--jitter"]),
+        loss=float(args["--loss"]),
+        block_time=float(args["--block-time"]),
+        seed=int(args["--seed"]),
+        compact=not args["--full-blocks"],
+        txs=int(args["--txs"]),
+    )
+    start_time = time.time()
+    results = simulation.run(blocks=int(args["--blocks"]))
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key:>18}: {value}")
+    print(f"{'wall_secs':>18}: {time.time() - start_time:.1f}")
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
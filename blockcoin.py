@@ -18,6 +18,7 @@ from docopt import docopt
 from copy import deepcopy
 from ecdsa import SigningKey, SECP256k1
 from utils import serialize, deserialize
+from signatures import sign, verify
 
 from identities import user_private_key, user_public_key, bank_private_key, bank_public_key, airdrop_tx
 
@@ -47,13 +48,13 @@ class Tx:
 
     def sign_input(self, index, private_key):
         message = spend_message(self, index)
-        signature = private_key.sign(message)
+        signature = sign(private_key, message)
         self.tx_ins[index].signature = signature
 
     def verify_input(self, index, public_key):
         tx_in = self.tx_ins[index]
         message = spend_message(self, index)
-        return public_key.verify(tx_in.signature, message)
+        return verify(public_key, tx_in.signature, message)
 
 class TxIn:
 
@@ -92,7 +93,7 @@ class Block:
         return serialize([self.timestamp, self.txns])
 
     def sign(self, private_key):
-        self.signature = private_key.sign(self.message)
+        self.signature = sign(private_key, self.message)
 
 class Bank:
 
@@ -170,7 +171,7 @@ class Bank:
         # Genesis block has no signature
         if len(self.blocks) > 0:
             public_key = bank_public_key(self.next_id)
-            public_key.verify(block.signature, block.message)
+            verify(public_key, block.signature, block.message)
 
         # Check the transactions are valid
         for tx in block.txns:
@@ -1,8 +1,8 @@
-from ecdsa import SigningKey, SECP256k1
 from utils import serialize
+from signatures import generate_private_key, sign, verify
 
 
-bank_private_key = SigningKey.generate(curve=SECP256k1)
+bank_private_key = generate_private_key()
 bank_public_key = bank_private_key.get_verifying_key()
 
 
@@ -29,13 +29,14 @@ class ECDSACoin:
         # Check the first transfer
         transfer = self.transfers[0]
         message = serialize(transfer.public_key)
-        assert bank_public_key.verify(transfer.signature, message)
+        assert verify(bank_public_key, transfer.signature, message)
 
         # Check the subsequent transfers
         previous_transfer = self.transfers[0]
         for transfer in self.transfers[1:]:
             # Check previous owner signed this transfer using their private key
-            assert previous_transfer.public_key.verify(
+            assert verify(
+                previous_transfer.public_key,
                 transfer.signature,
                 transfer_message(previous_transfer.signature, transfer.public_key),
 
@@ -48,7 +49,7 @@ def issue(public_key):
     message = serialize(public_key)
     
     # Create the first transfer, signing with the banks private key
-    signature = bank_private_key.sign(message)
+    signature = sign(bank_private_key, message)
     transfer = Transfer(
         signature=signature,
         public_key=public_key,
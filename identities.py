@@ -1,9 +1,9 @@
-from ecdsa import SigningKey, SECP256k1
+from signatures import private_key_from_exponent
 
-alice_private_key = SigningKey.from_secret_exponent(1, curve=SECP256k1)
+alice_private_key = private_key_from_exponent(1)
 alice_public_key = alice_private_key.get_verifying_key()
 
-bob_private_key = SigningKey.from_secret_exponent(2, curve=SECP256k1)
+bob_private_key = private_key_from_exponent(2)
 bob_public_key = bob_private_key.get_verifying_key()
 
 
@@ -24,7 +24,7 @@ def bank_private_key(id):
     assert isinstance(id, int)
     assert id >= 0
     base = 1000  # So bank keys don't collide with user keys ...
-    return SigningKey.from_secret_exponent(base + id, curve=SECP256k1)
+    return private_key_from_exponent(base + id)
 
 
 def bank_public_key(id):
@@ -1,5 +1,6 @@
 import io
 import pickle
+import utils
 from PIL import Image
 
 
@@ -34,15 +35,11 @@ class PNGCoin:
         return pickle.loads(serialized)
 
     def to_disk(self, filename):
-        serialized = self.serialize()
-        with open(filename, "wb") as f:
-            f.write(serialized)
+        utils.to_disk(self, filename)
 
     @classmethod
     def from_disk(cls, filename):
-        with open(filename, "rb") as f:
-            serialized = f.read()
-            return cls.deserialize(serialized)
+        return utils.from_disk(filename)
 
     def validate(self):
         for transfer in self.transfers:
@@ -0,0 +1,145 @@
+"""
+Signature backends
+
+Every sign / verify goes through here so a native secp256k1 library can
+stand in for pure-Python ecdsa. Keys are ecdsa SigningKey / VerifyingKey
+objects whichever backend is selected, and both backends produce and accept
+the same raw r||s signatures over the same digest.
+
+Set SIGNATURE_BACKEND to "python", "native" or "auto" (the default). Run this
+file to benchmark the available backends.
+"""
+
+import hashlib, logging, os, time
+
+from functools import lru_cache
+from ecdsa import SigningKey, SECP256k1, BadSignatureError
+from ecdsa.util import sigencode_der, sigdecode_der, sigencode_string, sigdecode_string
+
+ORDER = SECP256k1.order
+
+logger = logging.getLogger(__name__)
+
+
+class PythonBackend:
+
+    name = "python-ecdsa"
+
+    def sign(self, private_key, message):
+        return private_key.sign(message)
+
+    def verify(self, public_key, signature, message):
+        return public_key.verify(signature, message)
+
+
+class NativeBackend:
+
+    name = "coincurve"
+
+    def __init__(self):
+        # Raises ImportError if libsecp256k1 bindings aren't installed
+        import coincurve
+        self.coincurve = coincurve
+        self.native_private_key = lru_cache(maxsize=1024)(coincurve.PrivateKey)
+        self.native_public_key = lru_cache(maxsize=10_000)(coincurve.PublicKey)
+
+    def digest(self, key, message):
+        # The digest python-ecdsa signs, sized to the 32 bytes libsecp256k1 takes
+        digest = key.default_hashfunc(message).digest()
+        return digest[:32].rjust(32, b"\x00")
+
+    def sign(self, private_key, message):
+        native_key = self.native_private_key(private_key.to_string())
+        der = native_key.sign(self.digest(private_key, message), hasher=None)
+        r, s = sigdecode_der(der, ORDER)
+        return sigencode_string(r, s, ORDER)
+
+    def verify(self, public_key, signature, message):
+        try:
+            r, s = sigdecode_string(signature, ORDER)
+            # libsecp256k1 only accepts low-s, python-ecdsa signs either
+            if s > ORDER // 2:
+                s = ORDER - s
+            native_key = self.native_public_key(b"\x04" + public_key.to_string())
+            valid = native_key.verify(sigencode_der(r, s, ORDER),
+                    self.digest(public_key, message), hasher=None)
+        except Exception:
+            valid = False
+        if not valid:
+            raise BadSignatureError("Signature verification failed")
+        return True
+
+
+def compatible(candidate):
+    # Signatures must verify in both directions against python-ecdsa
+    reference = PythonBackend()
+    private_key = private_key_from_exponent(1)
+    public_key = private_key.get_verifying_key()
+    message = b"backend self-test"
+    try:
+        candidate.verify(public_key, reference.sign(private_key, message), message)
+        reference.verify(public_key, candidate.sign(private_key, message), message)
+        return True
+    except Exception:
+        return False
+
+def select_backend(name="auto"):
+    if name != "python":
+        try:
+            native = NativeBackend()
+            if compatible(native):
+                return native
+            logger.warning("Native signature backend failed self-test")
+        except ImportError:
+            if name == "native":
+                logger.warning("Native signature backend not installed")
+    return PythonBackend()
+
+
+def private_key_from_exponent(secret_exponent):
+    return SigningKey.from_secret_exponent(secret_exponent, curve=SECP256k1)
+
+def generate_private_key():
+    return SigningKey.generate(curve=SECP256k1)
+
+def sign(private_key, message):
+    return backend.sign(private_key, message)
+
+def verify(public_key, signature, message):
+    """Returns True, or raises BadSignatureError"""
+    return backend.verify(public_key, signature, message)
+
+
+backend = select_backend(os.environ.get("SIGNATURE_BACKEND", "auto"))
+
+
+#############
+# Benchmark #
+#############
+
+def benchmark(backend, iterations=200):
+    private_key = private_key_from_exponent(12345)
+    public_key = private_key.get_verifying_key()
+    messages = [hashlib.sha256(str(i).encode()).digest()
+                for i in range(iterations)]
+
+    start_time = time.time()
+    signatures = [backend.sign(private_key, m) for m in messages]
+    sign_rate = iterations / (time.time() - start_time)
+
+    start_time = time.time()
+    for message, signature in zip(messages, signatures):
+        backend.verify(public_key, signature, message)
+    verify_rate = iterations / (time.time() - start_time)
+
+    print(f"{backend.name:>14}: sign {sign_rate:>9.0f} ops/s   "
+          f"verify {verify_rate:>9.0f} ops/s")
+
+
+if __name__ == "__main__":
+    print(f"selected backend: {backend.name}")
+    benchmark(PythonBackend())
+    try:
+        benchmark(NativeBackend())
+    except ImportError:
+        print("     coincurve: not installed (pip install coincurve)")
@@ -1,3 +1,4 @@
+import os
 import pickle
 import uuid
 
@@ -11,15 +12,38 @@ def deserialize(serialized):
 
 
 def to_disk(coin, filename):
-    serialized = serialize(coin)
-    with open(filename, "wb") as f:
-        f.write(serialized)
+    # Pickle straight into a temp file, then rename it over the old one, so
+    # the coin is never held twice in memory and a crash can't leave it
+    # half written
+    temp = filename + ".tmp"
+    try:
+        with open(temp, "wb") as f:
+            pickle.dump(coin, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+
+def fsync_directory(path):
+    # The rename is only durable once the directory is synced too. Windows
+    # can't open directories, and doesn't need to
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
 def from_disk(filename):
+    # Unpickle from the file as it's read, in buffered chunks
     with open(filename, "rb") as f:
-        serialized = f.read()
-        return deserialize(serialized)
+        return pickle.load(f)
 
 
 ##################################################
@@ -0,0 +1,54 @@
+import os
+import pickle
+import tracemalloc
+
+import pytest
+
+from utils import to_disk, from_disk
+
+
+def test_round_trip(tmpdir):
+    filename = str(tmpdir.join("coin"))
+    coin = {"transfers": [b"signature", b"another signature"]}
+    to_disk(coin, filename)
+    assert from_disk(filename) == coin
+
+    # Overwriting replaces the old coin, leaving nothing else behind
+    to_disk([coin, coin], filename)
+    assert from_disk(filename) == [coin, coin]
+    assert os.listdir(str(tmpdir)) == ["coin"]
+
+
+def test_failed_write_keeps_old_coin(tmpdir):
+    filename = str(tmpdir.join("coin"))
+    to_disk("old coin", filename)
+
+    # Lambdas can't be pickled, so this fails partway through writing
+    with pytest.raises((pickle.PicklingError, AttributeError)):
+        to_disk(["new coin", lambda: None], filename)
+    assert from_disk(filename) == "old coin"
+    assert os.listdir(str(tmpdir)) == ["coin"]
+
+
+def test_streams_large_coins(tmpdir):
+    filename = str(tmpdir.join("coin"))
+    coin = [os.urandom(1024 * 1024) for _ in range(16)]
+
+    # Neither direction holds a second copy of the coin in memory
+    tracemalloc.start()
+    try:
+        to_disk(coin, filename)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024 * 1024
+
+    del coin
+    tracemalloc.start()
+    try:
+        coin = from_disk(filename)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 18 * 1024 * 1024
+    assert len(coin) == 16